@@ -0,0 +1,212 @@
+# Rebuild world maps offline from recorded frames
+#
+# perception_step maps one live frame at a time. Here a whole stack of camera
+# frames and their poses is mapped in chunks: every frame of a chunk is
+# classified with one lookup table pass, warped with one gather through the
+# nearest neighbour warp table, and all the world map hits of the chunk are
+# counted with a single np.bincount (rock samples are still detected frame by
+# frame, on the few frames that have rock pixels). The counts are added to an
+# OccupancyGrid so the worldmap is the same perception_step builds from the
+# same frames.
+#   $ python batch_mapping.py recording_folder --workers 4 --output worldmap.npy
+import argparse
+import os
+import numpy as np
+import cv2
+from concurrent.futures import ProcessPoolExecutor
+
+from perception import (ColorClassifier, RoverGeometry, WarpContext, calibration_points,
+                        detect_rocks, NAVIGABLE, OBSTACLE, ROCK)
+from occupancy import OccupancyGrid
+from telemetry import convert_to_float, convert_to_floats
+
+# Columns of a pose array, one row per frame
+pose_columns = ('x', 'y', 'yaw', 'pitch', 'roll')
+
+# Define a function to get the pose of a telemetry data dictionary
+def telemetry_pose(telemetry):
+    x, y = convert_to_floats(telemetry['position'])
+    return (x, y, convert_to_float(telemetry['yaw']),
+            convert_to_float(telemetry['pitch']), convert_to_float(telemetry['roll']))
+
+# Batch version of the mapping part of perception_step
+# Takes the same settings as the RoverState fields of the same name
+class BatchMapper():
+    def __init__(self, shape=(160, 320), world_size=200, dst_size=5, bottom_offset=6,
+                 nav_thresh=(160, 160, 160), rock_lower=(24 - 5, 100, 100),
+                 rock_upper=(24 + 5, 255, 255), view_range=80, scale=10.0):
+        self.shape = tuple(shape[:2])
+        self.world_size = world_size
+        self.scale = scale
+        self.classifier = ColorClassifier(nav_thresh, rock_lower, rock_upper)
+        warp = WarpContext(self.shape, *calibration_points(self.shape, dst_size, bottom_offset))
+        geometry = RoverGeometry(self.shape, view_range)
+        # Camera pixel seen by every warped pixel inside the field of view,
+        # the others are UNKNOWN and never reach the map
+        rows, cols = self.shape
+        source_x = warp.nearest_map[..., 0].ravel().astype(np.intp)
+        source_y = warp.nearest_map[..., 1].ravel().astype(np.intp)
+        in_view = (source_x >= 0) & (source_x < cols) & (source_y >= 0) & (source_y < rows)
+        self.pixels = np.flatnonzero(in_view)
+        self.source = (source_y * cols + source_x)[in_view]
+        self.x_pixel = geometry.x_pixel[in_view]
+        self.y_pixel = geometry.y_pixel[in_view]
+        self.in_range = geometry.in_range.ravel()[in_view]
+
+    # Count the world map hits of a chunk of frames
+    # frames is an (n, rows, cols, 3) RGB stack and poses an (n, 5) array
+    # (see pose_columns). Returns hits shaped like OccupancyGrid.counts
+    def hits(self, frames, poses):
+        poses = np.asarray(poses, dtype=np.float64)
+        # Only frames with pitch and roll near zero update the map
+        pitch, roll = poses[:, 3], poses[:, 4]
+        level = ((pitch < 1) | (pitch > 359)) & ((roll < 1) | (roll > 359))
+        frames, poses = frames[level], poses[level]
+        size = self.world_size
+        if len(frames) == 0:
+            return np.zeros((size, size, 3), dtype=np.int64)
+        # Label the warped field of view of every frame
+        labels = self.classifier.classify(np.ascontiguousarray(frames))
+        labels = labels.reshape(len(frames), -1)[:, self.source]
+        # Rocks count as obstacles, navigable and obstacles are limited to the view range
+        navigable = (labels == NAVIGABLE) & self.in_range
+        obstacles = ((labels & OBSTACLE) > 0) & self.in_range
+        rock_samples = labels == ROCK
+        cells = []
+        for channel, mask in ((0, obstacles), (2, navigable)):
+            frame, pixel = np.nonzero(mask)
+            # Same operations as pix_to_world, with the pose of each pixel's frame
+            yaw_rad = poses[frame, 2] * np.pi / 180
+            cos, sin = np.cos(yaw_rad), np.sin(yaw_rad)
+            x_pixel, y_pixel = self.x_pixel[pixel], self.y_pixel[pixel]
+            x_world = (x_pixel * cos - y_pixel * sin) / self.scale + poses[frame, 0]
+            y_world = (x_pixel * sin + y_pixel * cos) / self.scale + poses[frame, 1]
+            x_world = np.clip(np.int_(x_world), 0, size - 1)
+            y_world = np.clip(np.int_(y_world), 0, size - 1)
+            cells.append((y_world * size + x_world) * 3 + channel)
+        # Rock samples are detected frame by frame as perception_step does,
+        # only the few frames with rock pixels have any
+        rock_mask = np.zeros(self.shape, dtype=np.bool_)
+        for frame in np.flatnonzero(rock_samples.any(axis=1)):
+            rock_mask.fill(False)
+            rock_mask.flat[self.pixels[rock_samples[frame]]] = True
+            rocks = detect_rocks(rock_mask, poses[frame, 0], poses[frame, 1], poses[frame, 2],
+                                 size, self.scale)
+            cells.append(np.array([(rock.y_world * size + rock.x_world) * 3 + 1 for rock in rocks],
+                                  dtype=np.int_))
+        hits = np.bincount(np.concatenate(cells), minlength=size * size * 3)
+        return hits.reshape(size, size, 3)
+
+    # Same as hits() for a chunk of JPEG images as recorded by recorder.py
+    def jpeg_hits(self, jpegs, poses):
+        frames = np.empty((len(jpegs),) + self.shape + (3,), dtype=np.uint8)
+        for frame, jpeg in zip(frames, jpegs):
+            bgr = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=frame)
+        return self.hits(frames, poses)
+
+# Define a function to split frame and pose arrays in chunks
+# Memmapped arrays (np.load(path, mmap_mode='r')) are read one chunk at a time
+def array_chunks(frames, poses, chunk_size=64):
+    for start in range(0, len(frames), chunk_size):
+        yield frames[start:start + chunk_size], poses[start:start + chunk_size]
+
+# Define a function to read a recording (recorder.RecordingReader) in chunks
+# of JPEG images and poses, the images are decoded by the mapper
+def recording_chunks(reader, chunk_size=64):
+    jpegs, poses = [], []
+    for timestamp, jpeg, telemetry in reader:
+        jpegs.append(jpeg)
+        poses.append(telemetry_pose(telemetry))
+        if len(jpegs) == chunk_size:
+            yield jpegs, np.array(poses)
+            jpegs, poses = [], []
+    if jpegs:
+        yield jpegs, np.array(poses)
+
+# Mapper of a worker process
+_mapper = None
+
+def _init_worker(mapper):
+    global _mapper
+    _mapper = mapper
+
+def _chunk_hits(frames, poses):
+    if isinstance(frames, list):
+        return _mapper.jpeg_hits(frames, poses)
+    return _mapper.hits(frames, poses)
+
+# Define a function to build a world map from chunks of frames and poses
+# Chunks come from array_chunks() or recording_chunks(). With workers > 0 the
+# chunks are mapped by a process pool, at most 2 chunks per worker are in
+# flight so memory stays bounded whatever the number of frames.
+# Returns the OccupancyGrid, its worldmap is the map perception_step builds.
+def build_map(chunks, mapper=None, workers=0, occupancy=None):
+    if mapper is None:
+        mapper = BatchMapper()
+    if occupancy is None:
+        size = mapper.world_size
+        occupancy = OccupancyGrid(np.zeros((size, size, 3), dtype=np.uint8))
+    if workers <= 0:
+        _init_worker(mapper)
+        for frames, poses in chunks:
+            occupancy.accumulate(_chunk_hits(frames, poses))
+        return occupancy
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(mapper,)) as pool:
+        pending = []
+        for frames, poses in chunks:
+            pending.append(pool.submit(_chunk_hits, frames, poses))
+            if len(pending) >= 2 * workers:
+                occupancy.accumulate(pending.pop(0).result())
+        for future in pending:
+            occupancy.accumulate(future.result())
+    return occupancy
+
+if __name__ == '__main__':
+    import time
+    from recorder import RecordingReader
+    parser = argparse.ArgumentParser(description='Build a world map from a recorded run')
+    parser.add_argument(
+        'recording',
+        type=str,
+        help='Path to a folder recorded by drive_rover.py, or an .npy stack of RGB frames.'
+    )
+    parser.add_argument(
+        '--poses',
+        type=str,
+        default='',
+        help='With an .npy frame stack, .npy array of x, y, yaw, pitch, roll per frame.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of worker processes (0 maps in this process).'
+    )
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=64,
+        help='Number of frames mapped at once.'
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        default='',
+        help='Save the worldmap to this .npy file.'
+    )
+    args = parser.parse_args()
+
+    if args.recording.endswith('.npy'):
+        frames = np.load(args.recording, mmap_mode='r')
+        mapper = BatchMapper(frames.shape[1:3])
+        chunks = array_chunks(frames, np.load(args.poses), args.chunk_size)
+    else:
+        mapper = BatchMapper()
+        chunks = recording_chunks(RecordingReader(args.recording), args.chunk_size)
+    start = time.perf_counter()
+    occupancy = build_map(chunks, mapper, args.workers)
+    print('Mapped in {:.2f} s, {} cells with navigable terrain'.format(
+        time.perf_counter() - start, np.count_nonzero(occupancy.counts[:, :, 2])))
+    if args.output:
+        np.save(args.output, occupancy.worldmap)
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import logging
+import threading
+import numpy as np
+
+from metrics import metrics
+from rock_registry import RockRegistry
+
+logger = logging.getLogger(__name__)
+
+# Files of a checkpoint folder
+#   counts.npy  occupancy hit counts, memory-mapped and updated in place every frame
+#   state.json  mission state (time, mode, samples, planner), replaced atomically
+counts_name = 'counts.npy'
+state_name = 'state.json'
+
+# Define a function to capture the mission state of the Rover
+# Only scalars and the few sample positions, cheap enough for the control loop
+def mission_state(Rover):
+    state = {
+        'saved_at': time.time(),
+        'total_time': Rover.total_time,
+        'mode': list(Rover.mode),
+        'stuck_time': Rover.stuck_time,
+        'rock_time': Rover.rock_time,
+        'samples_to_find': Rover.samples_to_find,
+        'samples_collected': Rover.samples_collected,
+        'pos': None if Rover.pos is None else list(Rover.pos),
+    }
+    if Rover.samples_pos is not None:
+        state['samples_pos'] = [np.asarray(values).tolist() for values in Rover.samples_pos]
+        state['samples_located'] = Rover.rock_registry.located.tolist()
+    planner = Rover.planner
+    if planner is not None and planner.home is not None:
+        state['planner'] = {
+            'home': list(planner.home),
+            'samples_collected': planner.samples_collected,
+            'collected': None if planner.collected is None else planner.collected.tolist(),
+        }
+    return state
+
+# Define a function to restore the mission state captured by mission_state()
+# The navigation time goes on from the saved total time
+def restore_mission(Rover, state):
+    if state.get('total_time') is not None:
+        Rover.start_time = Rover.clock() - state['total_time']
+        Rover.total_time = state['total_time']
+    Rover.mode = list(state['mode'])
+    Rover.stuck_time = state['stuck_time']
+    Rover.rock_time = state['rock_time']
+    Rover.samples_to_find = state['samples_to_find']
+    Rover.samples_collected = state['samples_collected']
+    if 'samples_pos' in state:
+        Rover.samples_pos = tuple(np.int_(values) for values in state['samples_pos'])
+        Rover.rock_registry = RockRegistry(Rover.samples_pos)
+        Rover.rock_registry.located[:] = state['samples_located']
+        Rover.samples_located = Rover.rock_registry.samples_located
+    planner = Rover.planner
+    if planner is not None and 'planner' in state:
+        planner.home = tuple(state['planner']['home'])
+        planner.samples_collected = state['planner']['samples_collected']
+        if state['planner']['collected'] is not None:
+            planner.collected = np.array(state['planner']['collected'], dtype=np.bool_)
+
+# Define a function to write a file atomically: written and synced to a
+# temporary file, then renamed over the previous version
+def write_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# Define a checkpointer of the map and mission state
+# The occupancy hit counts are moved to a memory-mapped file, so the map on
+# disk is the live map and a crashed process loses none of it. At most every
+# `interval` seconds submit() captures the mission state on the control loop
+# (a few scalars) and hands it over to a writer thread, which flushes the
+# mapped counts and replaces state.json atomically; the control loop never
+# waits on the disk. On resume the worldmap is rebuilt from the counts, the
+# map view and planner costmap are brought up to date through the occupancy
+# subscriptions and the mission state is restored.
+class Checkpointer():
+    def __init__(self, folder, interval=5.0):
+        self.folder = folder
+        self.interval = interval
+        self.counts = None
+        self.saved = 0
+        self._lock = threading.Condition()
+        self._pending = None
+        self._last_capture = None
+        self._running = True
+        os.makedirs(folder, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='checkpointer', daemon=True)
+        self._thread.start()
+
+    # Move the occupancy counts of the Rover to the checkpoint folder, or with
+    # resume=True restore the map and mission state saved there. A checkpoint
+    # already in the folder is only replaced by a new mission with overwrite=True
+    # Call after the planner is set up so that its costmap sees the restored map
+    # Returns True when a checkpoint was restored
+    def attach(self, Rover, resume=False, overwrite=False):
+        occupancy = Rover.occupancy
+        counts_path = os.path.join(self.folder, counts_name)
+        state_path = os.path.join(self.folder, state_name)
+        if resume and os.path.exists(counts_path):
+            counts = np.lib.format.open_memmap(counts_path, mode='r+')
+            if counts.shape != occupancy.counts.shape or counts.dtype != occupancy.counts.dtype:
+                raise ValueError("Checkpoint map {} {} does not match the rover map {} {}".format(
+                                 counts.shape, counts.dtype, occupancy.counts.shape, occupancy.counts.dtype))
+            occupancy.load(counts)
+            if os.path.exists(state_path):
+                with open(state_path) as f:
+                    restore_mission(Rover, json.load(f))
+            self.counts = counts
+            logger.info("Resumed from checkpoint %s", self.folder)
+            return True
+        if resume:
+            logger.warning("No checkpoint in %s, starting a new mission", self.folder)
+        elif not overwrite and (os.path.exists(counts_path) or os.path.exists(state_path)):
+            raise FileExistsError("A checkpoint already exists in {}".format(
+                                  self.folder))
+        counts = np.lib.format.open_memmap(counts_path, mode='w+', dtype=occupancy.counts.dtype,
+                                           shape=occupancy.counts.shape)
+        counts[:] = occupancy.counts
+        occupancy.counts = counts
+        # A state left by a previous mission does not belong to this map
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        self.counts = counts
+        return False
+
+    # Capture the mission state for writing if the interval allows it (or force is set)
+    def submit(self, Rover, force=False):
+        now = time.monotonic()
+        if (not force and self._last_capture is not None
+                and now - self._last_capture < self.interval):
+            return False
+        self._last_capture = now
+        state = mission_state(Rover)
+        with self._lock:
+            # A capture not written yet is replaced by the newer one
+            self._pending = state
+            self._lock.notify()
+        return True
+
+    # Write the pending capture and stop the writer
+    def close(self):
+        with self._lock:
+            self._running = False
+            self._lock.notify()
+        self._thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            with self._lock:
+                while self._pending is None and self._running:
+                    self._lock.wait()
+                state, self._pending = self._pending, None
+                running = self._running
+            if state is None:
+                continue
+            try:
+                with metrics.timer('checkpoint'):
+                    self._write(state)
+                self.saved += 1
+            except OSError:
+                logger.exception("Cannot write checkpoint to %s", self.folder)
+
+    def _write(self, state):
+        # The counts only grow, a page flushed a little after the state
+        # holds the same or more hits
+        if self.counts is not None:
+            self.counts.flush()
+        write_atomic(os.path.join(self.folder, state_name),
+                     json.dumps(state).encode('utf-8'))
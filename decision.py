@@ -1,31 +1,67 @@
 import numpy as np
 
+# Define a function to get the steering angle (degrees) towards the next
+# waypoint of the global planner, None without a planner or a route
+# The rover heads for the navigable direction seen by perception closest
+# to the bearing of the waypoint, so it follows the route around obstacles
+def waypoint_steer(Rover, nav, min_pixels=50):
+    if Rover.planner is None or nav is None:
+        return None
+    waypoint = Rover.planner.waypoint(Rover.pos)
+    if waypoint is None:
+        return None
+    bearing = np.arctan2(waypoint[1] - Rover.pos[1], waypoint[0] - Rover.pos[0]) - Rover.yaw * np.pi / 180
+    bearing = (bearing + np.pi) % (2 * np.pi) - np.pi
+    open_angles = nav.angle_centers()[nav.counts.sum(axis=1) >= min_pixels]
+    if len(open_angles) == 0:
+        return None
+    angle = open_angles[np.argmin(np.abs(open_angles - bearing))]
+    return np.clip(angle * 180 / np.pi, -15, 15)
+
 
 # This is where you can build a decision tree for determining throttle, brake and steer 
 # commands based on the output of the perception_step() function
 def decision_step(Rover):
+    Rover = decide(Rover)
+    # Keep the state of this frame, with the commands decided, in the flight recorder
+    if Rover.history is not None:
+        Rover.history.record(Rover)
+    return Rover
+
+def decide(Rover):
+
+    # Navigable terrain is read from the constant size summary built by perception
+    nav = Rover.nav_summary
+
+    # Bring the global route up to date within its time budget
+    if Rover.planner is not None:
+        Rover.planner.update(Rover)
+        # Mission complete, wait at the start position
+        if Rover.planner.finished:
+            Rover.throttle = 0
+            Rover.brake = Rover.brake_set
+            Rover.steer = 0
+            return Rover
 
     # offset in rad used to hug the left wall.
     offset = 0
     # Only apply left wall hugging when out of the starting point (after 10s)
     # to avoid getting stuck in a circle
-    if Rover.total_time > 10:
+    if Rover.total_time > 10 and nav is not None:
         # Steering proportional to the deviation results in
         # small offsets on straight lines and
         # large values in turns and open areas
-        offset = 0.8 * np.std(Rover.nav_angles)
+        offset = 0.8 * nav.std_angle
 
     # Check if we have vision data to make decisions with
-    if Rover.nav_angles is not None:
+    if nav is not None:
         
         # Always prioritize yellow streak detection
-        if Rover.samples_angles is not None and len(Rover.samples_angles) > 0:
-            # Compute distances to all detected samples
-            samples_dists = np.sqrt(Rover.samples_dists)
-            # Find the index of the closest sample
-            closest_sample_idx = np.argmin(samples_dists)
+        if Rover.rock_detections:
+            # Find the closest detected sample
+            closest_sample = min(Rover.rock_detections, key=lambda rock: rock.distance)
             # Get the angle to the closest sample
-            closest_sample_angle = Rover.samples_angles[closest_sample_idx] * 180 / np.pi
+            closest_sample_angle = closest_sample.bearing * 180 / np.pi
             
             # Steer towards the closest sample
             Rover.steer = np.clip(closest_sample_angle, -15, 15)
@@ -52,16 +88,20 @@ def decision_step(Rover):
             return Rover
 
         # Check if we have vision data to make decisions with
-    if Rover.nav_angles is not None:
+    if nav is not None:
         # Check for Rover.mode status. I made Rover.mode a stack
         if Rover.mode[-1] == 'forward':
 
             # Check the extent of navigable terrain
-            if len(Rover.nav_angles) >= Rover.stop_forward:
+            if nav.count >= Rover.stop_forward:
                 # If mode is forward, navigable terrain looks good
                 # Except for start, if stopped means stuck.
                 # Alternates between stuck and forward modes
-                if Rover.vel <= 0.1 and Rover.total_time - Rover.stuck_time > 4:
+                stopped = Rover.vel <= 0.1
+                # Also stuck when throttling without getting anywhere for 3 seconds
+                if Rover.stall_check and Rover.history is not None:
+                    stopped = stopped or Rover.history.stalled(3, 0.5)
+                if stopped and Rover.total_time - Rover.stuck_time > 4:
                     # Set mode to "stuck" and hit the brakes!
                     Rover.throttle = 0
                     # Set brake to stored brake value
@@ -77,12 +117,16 @@ def decision_step(Rover):
                     Rover.throttle = 0
                 Rover.brake = 0
                 # Set steering to average angle clipped to the range +/- 15
-                # Rover.steer = np.clip(np.mean(Rover.nav_angles * 180/np.pi), -15, 15)
+                # Rover.steer = np.clip(nav.mean_angle * 180/np.pi, -15, 15)
                 # Hug left wall by setting the steer angle slightly to the left
-                Rover.steer = np.clip(np.mean((Rover.nav_angles+offset) * 180 / np.pi), -15, 15)
+                Rover.steer = np.clip((nav.mean_angle + offset) * 180 / np.pi, -15, 15)
+                # Follow the planned route instead when there is one
+                steer = waypoint_steer(Rover, nav)
+                if steer is not None:
+                    Rover.steer = steer
 
             # If there's a lack of navigable terrain pixels then go to 'stop' mode
-            elif len(Rover.nav_angles) < Rover.stop_forward or Rover.vel <= 0:
+            elif nav.count < Rover.stop_forward or Rover.vel <= 0:
                     # Set mode to "stop" and hit the brakes!
                     Rover.throttle = 0
                     # Set brake to stored brake value
@@ -100,7 +144,7 @@ def decision_step(Rover):
                 Rover.brake = 0
                 # Set steer to mean angle
                 # Hug left wall by setting the steer angle slightly to the left
-                Rover.steer = np.clip(np.mean((Rover.nav_angles+offset) * 180 / np.pi), -15, 15)
+                Rover.steer = np.clip((nav.mean_angle + offset) * 180 / np.pi, -15, 15)
                 Rover.mode.pop() # returns to previous mode
             # Now we're stopped and we have vision data to see if there's a path forward
             else:
@@ -121,7 +165,7 @@ def decision_step(Rover):
             # If we're not moving (vel < 0.2) then do something else
             elif Rover.vel <= 0.2:
                 # Now we're stopped and we have vision data to see if there's a path forward
-                if len(Rover.nav_angles) < Rover.go_forward:
+                if nav.count < Rover.go_forward:
                     Rover.throttle = 0
                     # Release the brake to allow turning
                     Rover.brake = 0
@@ -129,7 +173,7 @@ def decision_step(Rover):
                     # Since hugging left wall steering should be to the right:
                     Rover.steer = -15
                 # If we're stopped but see sufficient navigable terrain in front then go!
-                if len(Rover.nav_angles) >= Rover.go_forward:
+                if nav.count >= Rover.go_forward:
                     # Set throttle back to stored value
                     Rover.throttle = Rover.throttle_set
                     # Release the brake
@@ -137,7 +181,7 @@ def decision_step(Rover):
                     # Set steer to mean angle
                     # Hug left wall by setting the steer angle slightly to the left
                     offset = 12
-                    Rover.steer = np.clip(np.mean(Rover.nav_angles * 180 / np.pi) + offset, -15, 15)
+                    Rover.steer = np.clip(nav.mean_angle * 180 / np.pi + offset, -15, 15)
                     Rover.mode.pop()  # returns to previous mode
               
     # If no vision data is available
@@ -1,123 +1,127 @@
 # Do the necessary imports
 import argparse
 import shutil
+import socket
 import base64
-from datetime import datetime
 import os
 import cv2
 import numpy as np
 import socketio
 import eventlet
 import eventlet.wsgi
-from PIL import Image
 from flask import Flask
 from io import BytesIO, StringIO
 import json
 import pickle
-import matplotlib.image as mpimg
 import time
+import logging
 
 # Import functions for perception and decision making
 from perception import perception_step
 from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+from supporting_functions import update_rover, encode_output_images, JpegEncoder
+from inset_renderer import InsetRenderer
+from pipeline import FramePipeline
+from recorder import FrameRecorder
+from rover_state import RoverState, load_ground_truth
+from metrics import metrics, MetricsReporter
+from flight_recorder import FlightRecorder
+from sessions import SessionManager, ShardedSessionManager
+from planner import Planner
+from governor import FrameGovernor
+from checkpoint import Checkpointer
+from transport import ControlPayload
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
-# Read in ground truth map and create 3-channel green version for overplotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
-
-# Define RoverState() class to retain rover state parameters
-class RoverState():
-    def __init__(self):
-        self.start_time = None # To record the start time of navigation
-        self.total_time = None # To record total duration of naviagation
-        self.stuck_time = 0 # To record moment that got stuck
-        self.rock_time = 0 # To record moment that started to go for the near rock sample
-        self.img = None # Current camera image
-        self.pos = None # Current position (x, y)
-        self.yaw = None # Current yaw angle
-        self.pitch = None # Current pitch angle
-        self.roll = None # Current roll angle
-        self.vel = None # Current velocity
-        self.steer = 0 # Current steering angle
-        self.throttle = 0 # Current throttle value
-        self.brake = 0 # Current brake value
-        self.nav_angles = None  # Angles of navigable terrain pixels
-        self.nav_dists = None # Distances of navigable terrain pixels
-        self.samples_angles = None  # Angles of rock sample pixels
-        self.samples_dists = None  # Distances of rock sample pixels
-        self.ground_truth = ground_truth_3d # Ground truth worldmap
-        self.mode = ['forward'] # Current mode (can be forward or stop)
-        self.throttle_set = 0.5 # Throttle setting when accelerating
-        self.brake_set = 10 # Brake setting when braking
-        # The stop_forward and go_forward fields below represent total count
-        # of navigable terrain pixels.  This is a very crude form of knowing
-        # when you can keep going and when you should stop.  Feel free to
-        # get creative in adding new fields or modifying these!
-        self.stop_forward = 100 # Threshold to initiate stopping
-        self.go_forward = 500 # Threshold to go forward again
-        self.max_vel = 3 # Maximum velocity (meters/second)
-        # Image output from perception step
-        # Update this image to display your intermediate analysis steps
-        # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
-        # Worldmap
-        # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float) 
-        self.samples_pos = None # To store the actual sample positions
-        self.samples_to_find = 0 # To store the initial count of samples
-        self.samples_located = 0 # To store number of samples located on map
-        self.samples_collected = 0 # To count the number of samples collected
-        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
-        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
-        self.send_pickup = False # Set to True to trigger rock pickup
-# Initialize our rover 
-Rover = RoverState()
-
-# Variables to track frames per second (FPS)
-# Intitialize frame counter
-frame_counter = 0
-# Initalize second counter
-second_counter = time.time()
-fps = None
+# Ground truth map and rover, created at startup (see --map) so that
+# importing this module stays cheap
+ground_truth_3d = None
+Rover = None
+
+# Encoders of the inset images, and the background renderer
+# used instead when rendering at a limited rate (--render-rate)
+encoders = (JpegEncoder(), JpegEncoder())
+renderer = None
+# Staged frame pipeline, used when started with --pipeline
+pipeline = None
+# Recorder of the camera images and telemetry, used when an image folder is given
+recorder = None
+# Per-client rovers, used when started with --sessions
+sessions = None
+# Builder of the control replies, remembers the insets sent to each client (see --transport)
+payloads = ControlPayload()
 
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
 def telemetry(sid, data):
 
-    global frame_counter, second_counter, fps
-    frame_counter+=1
-    # Do a rough calculation of frames per second (FPS)
-    if (time.time() - second_counter) > 1:
-        fps = frame_counter
-        frame_counter = 0
-        second_counter = time.time()
-    print("Current FPS: {}".format(fps))
+    metrics.increment('frames')
+    # Optional sampled status line, printing every frame costs frames
+    if args.print_every and metrics.counters['frames'] % args.print_every == 0:
+        print(metrics.summary_line())
+
+    if sessions is not None:
+        # Each simulator drives its own rover, reply to that client only
+        if data:
+            with metrics.timer('session_frame'):
+                event, reply = sessions.process(sid, data)
+            if event == 'pickup':
+                send_pickup(sid)
+            else:
+                send_control(*reply, sid=sid)
+        else:
+            sio.emit('manual', data={}, room=sid)
+
+    elif data and pipeline is not None:
+        # Record the frame before the pipeline, which drops stale frames,
+        # so only the recorder's drop policy decides what is recorded
+        if recorder is not None:
+            recorder.record_telemetry(data)
+        # Hand the telemetry over to the pipeline and answer at once
+        # with the commands decided for the freshest frame
+        pipeline.submit(data)
+        commands = pipeline.commands()
+        metrics.set_gauge('dropped_frames', pipeline.dropped)
+        if commands.pickup:
+            send_pickup()
+        else:
+            out_image1, out_image2 = renderer.take()
+            with metrics.timer('send_control'):
+                send_control((commands.throttle, commands.brake, commands.steer),
+                             out_image1, out_image2)
 
-    if data:
+    elif data:
         global Rover
         # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
+        with metrics.timer('update_rover'):
+            Rover, frame = update_rover(Rover, data)
 
         if np.isfinite(Rover.vel):
 
             # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
-            Rover = decision_step(Rover)
+            start = time.perf_counter()
+            with metrics.timer('perception_step'):
+                Rover = perception_step(Rover)
+            # Lower the perception quality when perception takes longer than the budget
+            if Rover.governor is not None:
+                Rover.governor.observe(time.perf_counter() - start)
+            with metrics.timer('decision_step'):
+                Rover = decision_step(Rover)
 
             # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
+            if renderer is not None:
+                # Drawn in the background, send the most recent images
+                # (or none if they did not change since the last reply)
+                renderer.submit(Rover)
+                out_image1, out_image2 = renderer.take()
+            else:
+                with metrics.timer('create_output_images'):
+                    out_image1, out_image2 = encode_output_images(Rover, encoders)
 
             # The action step!  Send commands to the rover!
  
@@ -133,58 +137,75 @@ def telemetry(sid, data):
             else:
                 # Send commands to the rover!
                 commands = (Rover.throttle, Rover.brake, Rover.steer)
-                send_control(commands, out_image_string1, out_image_string2)
+                with metrics.timer('send_control'):
+                    send_control(commands, out_image1, out_image2)
+
+            # Checkpoint the mission state now and then, written in the background
+            if Rover.checkpoint is not None:
+                Rover.checkpoint.submit(Rover)
 
         # In case of invalid telemetry, send null commands
         else:
+            metrics.increment('invalid_frames')
 
             # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
+            send_control((0, 0, 0), b'', b'')
 
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+        save_frame(frame)
 
     else:
         sio.emit('manual', data={}, skip_sid=True)
 
+# Latency histograms and counters of the running server as JSON
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.snapshot()
+
+# If you want to save camera images from autonomous driving specify a path
+# Example: $ python drive_rover.py image_folder_path
+# Frames are written by the recorder in the background together with their telemetry
+def save_frame(frame):
+    # Conditional to save image frame if folder was specified
+    if recorder is not None:
+        recorder.record(frame)
+
 @sio.on('connect')
 def connect(sid, environ):
     print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    # Without sessions every message is broadcast to all clients
+    session_sid = sid if sessions is not None else None
+    # A new client has none of the insets sent so far
+    payloads.forget(session_sid)
+    send_control((0, 0, 0), b'', b'', sid=session_sid)
     sample_data = {}
-    sio.emit(
-        "get_samples",
-        sample_data,
-        skip_sid=True)
+    emit("get_samples", sample_data, session_sid)
+
+@sio.on('disconnect')
+def disconnect(sid):
+    if sessions is not None:
+        sessions.disconnect(sid)
+        payloads.forget(sid)
+
+# Define a function to send an event to one client (sid) or to all of them
+def emit(event, data, sid=None):
+    if sid is None:
+        sio.emit(event, data, skip_sid=True)
+    else:
+        sio.emit(event, data, room=sid)
 
-def send_control(commands, image_string1, image_string2):
+# The insets are JPEG bytes, b'' when there is no new image
+def send_control(commands, image1, image2, sid=None):
     # Define commands to be sent to the rover
-    data={
-        'throttle': commands[0].__str__(),
-        'brake': commands[1].__str__(),
-        'steering_angle': commands[2].__str__(),
-        'inset_image1': image_string1,
-        'inset_image2': image_string2,
-        }
+    data = payloads.data(commands, image1, image2, sid)
     # Send commands via socketIO server
-    sio.emit(
-        "data",
-        data,
-        skip_sid=True)
+    emit("data", data, sid)
     eventlet.sleep(0)
 # Define a function to send the "pickup" command 
-def send_pickup():
-    print("Picking up")
+def send_pickup(sid=None):
+    metrics.increment('pickups')
+    logger.info("Picking up")
     pickup = {}
-    sio.emit(
-        "pickup",
-        pickup,
-        skip_sid=True)
+    emit("pickup", pickup, sid)
     eventlet.sleep(0)
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
@@ -195,7 +216,175 @@ if __name__ == '__main__':
         default='',
         help='Path to image folder. This is where the images from the run will be saved.'
     )
+    parser.add_argument(
+        '--record-queue',
+        type=int,
+        default=256,
+        help='Number of frames waiting to be written before the drop policy applies.'
+    )
+    parser.add_argument(
+        '--drop-policy',
+        choices=['newest', 'oldest', 'block'],
+        default='newest',
+        help='Frames to drop when the recorder falls behind, block waits for the disk instead.'
+    )
+    parser.add_argument(
+        '--render-rate',
+        type=float,
+        default=0,
+        help='Render the inset images in the background at this rate (Hz). 0 renders them for every frame.'
+    )
+    parser.add_argument(
+        '--encoder',
+        choices=['pil', 'cv2'],
+        default='pil',
+        help='JPEG encoder of the inset images, cv2 is faster.'
+    )
+    parser.add_argument(
+        '--transport',
+        choices=['base64', 'binary'],
+        default='base64',
+        help='Send the inset images as base64 strings (what the simulator expects) or as binary attachments.'
+    )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Run decoding, perception, decision and rendering as concurrent stages, dropping stale frames.'
+    )
+    parser.add_argument(
+        '--sessions',
+        action='store_true',
+        help='Drive one rover per connected simulator instead of a single shared rover (with its own planner and governor).'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='With --sessions, shard the sessions across this many worker processes (0 runs them in this process).'
+    )
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        help='Follow routes of the global planner to frontiers, located samples and back to the start.'
+    )
+    parser.add_argument(
+        '--plan-budget',
+        type=float,
+        default=5,
+        help='Planning time budget per frame, in milliseconds.'
+    )
+    parser.add_argument(
+        '--frame-budget',
+        type=float,
+        default=0,
+        help='Perception budget per frame in milliseconds, perception quality is lowered while it takes longer (0 keeps full quality).'
+    )
+    parser.add_argument(
+        '--stall-check',
+        action='store_true',
+        help='Also count as stuck when the rover throttles for 3 s without moving 0.5 m (from the flight recorder).'
+    )
+    parser.add_argument(
+        '--history-file',
+        type=str,
+        default='',
+        help='Memory-map the flight recorder of the rover state to this file.'
+    )
+    parser.add_argument(
+        '--checkpoint',
+        type=str,
+        default='',
+        help='Keep the map memory-mapped in this folder and checkpoint the mission state there in the background.'
+    )
+    parser.add_argument(
+        '--checkpoint-interval',
+        type=float,
+        default=5,
+        help='Seconds between two checkpoints of the mission state.'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='With --checkpoint, resume the map and mission saved in the checkpoint folder.'
+    )
+    parser.add_argument(
+        '--overwrite',
+        action='store_true',
+        help='With --checkpoint, start a new mission over a checkpoint already in the folder.'
+    )
+    parser.add_argument(
+        '--print-every',
+        type=int,
+        default=0,
+        help='Print the metrics summary every N frames (0 never prints).'
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        type=float,
+        default=10,
+        help='Log a metrics summary (at INFO level) every this many seconds, 0 disables it.'
+    )
+    parser.add_argument(
+        '--log-level',
+        default='INFO',
+        help='Logging level, DEBUG prints the telemetry of every frame.'
+    )
+    parser.add_argument(
+        '--map',
+        type=str,
+        default=None,
+        help='Ground truth map (defaults to $ROVER_MAP, then calibration_images/map_bw.png next to the code).'
+    )
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+    if args.sessions:
+        # Sessions get their own planner and governor, the options below
+        # only apply to the single shared rover
+        shared_only = [option for option, used in (
+            ('--pipeline', args.pipeline), ('--render-rate', args.render_rate > 0),
+            ('--history-file', args.history_file), ('--stall-check', args.stall_check),
+            ('--checkpoint', args.checkpoint),
+            ('image_folder', args.image_folder)) if used]
+        if shared_only:
+            parser.error('{} cannot be used with --sessions'.format(', '.join(shared_only)))
+
+    # Read in ground truth map and create 3-channel green version for overplotting
+    ground_truth_3d = load_ground_truth(args.map)
+    # Initialize our rover 
+    Rover = RoverState(ground_truth_3d)
+    if args.metrics_interval > 0:
+        MetricsReporter(metrics, args.metrics_interval)
+
+    if args.history_file:
+        Rover.history = FlightRecorder(path=args.history_file)
+    Rover.stall_check = args.stall_check
+    encoders = (JpegEncoder(args.encoder), JpegEncoder(args.encoder))
+    payloads = ControlPayload(args.transport)
+    if args.frame_budget > 0:
+        Rover.governor = FrameGovernor(args.frame_budget / 1000)
+    if args.plan:
+        Rover.planner = Planner(Rover.occupancy, budget=args.plan_budget / 1000)
+    if args.checkpoint:
+        # After the planner, so that its costmap sees a resumed map
+        if args.resume and args.overwrite:
+            parser.error('--resume and --overwrite cannot be used together')
+        Rover.checkpoint = Checkpointer(args.checkpoint, args.checkpoint_interval)
+        try:
+            Rover.checkpoint.attach(Rover, resume=args.resume, overwrite=args.overwrite)
+        except FileExistsError as error:
+            parser.error('{} (--resume or --overwrite)'.format(error))
+    elif args.resume or args.overwrite:
+        parser.error('--resume and --overwrite need --checkpoint')
+    plan_budget = args.plan_budget / 1000 if args.plan else 0
+    if args.sessions and args.workers > 0:
+        sessions = ShardedSessionManager(args.map, args.workers, args.encoder,
+                                         plan_budget, args.frame_budget / 1000)
+    elif args.sessions:
+        sessions = SessionManager(ground_truth_3d, args.encoder, plan_budget, args.frame_budget / 1000)
+    if args.render_rate > 0 or args.pipeline:
+        renderer = InsetRenderer(args.render_rate or 5, args.encoder)
+    if args.pipeline:
+        pipeline = FramePipeline(Rover, renderer)
     
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
@@ -205,6 +394,7 @@ if __name__ == '__main__':
         else:
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
+        recorder = FrameRecorder(args.image_folder, args.record_queue, args.drop_policy)
         print("Recording this run ...")
     else:
         print("NOT recording this run ...")
@@ -213,4 +403,19 @@ if __name__ == '__main__':
     app = socketio.Middleware(sio, app)
 
     # deploy as an eventlet WSGI server
-    eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
\ No newline at end of file
+    # Without Nagle's algorithm the binary attachments, sent as separate
+    # websocket messages, do not wait for the acknowledgement of the first one
+    listener = eventlet.listen(('', 4567))
+    listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+        eventlet.wsgi.server(listener, app)
+    finally:
+        # Write the frames still waiting in the recorder queue
+        if recorder is not None:
+            recorder.close()
+        if sessions is not None:
+            sessions.close()
+        # Save the latest mission state before exiting
+        if Rover.checkpoint is not None:
+            Rover.checkpoint.submit(Rover, force=True)
+            Rover.checkpoint.close()
\ No newline at end of file
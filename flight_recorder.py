@@ -0,0 +1,161 @@
+import numpy as np
+
+# Modes of decision_step stored as codes (255 for anything else)
+mode_codes = {'forward': 0, 'stop': 1, 'stuck': 2}
+mode_names = {code: mode for mode, code in mode_codes.items()}
+
+# Per-frame rover state kept by the flight recorder
+history_dtype = np.dtype([
+    ('time', 'f8'),
+    ('pos', 'f4', (2,)),
+    ('yaw', 'f4'),
+    ('pitch', 'f4'),
+    ('roll', 'f4'),
+    ('vel', 'f4'),
+    ('throttle', 'f4'),
+    ('brake', 'f4'),
+    ('steer', 'f4'),
+    ('mode', 'u1'),
+    ('nav_count', 'i4'),
+    ('sample_pixels', 'i4'),
+    ('samples_collected', 'i4'),
+    ('quality', 'u1'),
+])
+
+# File header: magic number, capacity and number of records written so far
+header_dtype = np.dtype([('magic', 'u8'), ('capacity', 'u8'), ('count', 'u8')])
+history_magic = 0x524f564552484953
+
+# Define a flight recorder: a fixed size ring buffer of per-frame rover state
+# Records live in a structured NumPy array, optionally memory-mapped to a file
+# so the history survives a crash and can be read live by another process
+# (FlightRecorder.open(path)). Recording a frame writes one row in place,
+# queries return the recent records in time order for vectorized use.
+class FlightRecorder():
+    def __init__(self, capacity=1 << 14, path=None):
+        if path is None:
+            self.header = np.zeros(1, dtype=header_dtype)
+            self.records = np.zeros(capacity, dtype=history_dtype)
+        else:
+            self.header = np.memmap(path, dtype=header_dtype, mode='w+', shape=(1,))
+            self.records = np.memmap(path, dtype=history_dtype, mode='r+',
+                                     offset=header_dtype.itemsize, shape=(capacity,))
+        self.header['magic'] = history_magic
+        self.header['capacity'] = capacity
+        self.header['count'] = 0
+        self._bind()
+
+    # Open a recorder file written by another process, read only
+    @classmethod
+    def open(cls, path):
+        recorder = cls.__new__(cls)
+        recorder.header = np.memmap(path, dtype=header_dtype, mode='r', shape=(1,))
+        if recorder.header['magic'][0] != history_magic:
+            raise ValueError("Not a flight recorder file: {}".format(path))
+        capacity = int(recorder.header['capacity'][0])
+        recorder.records = np.memmap(path, dtype=history_dtype, mode='r',
+                                     offset=header_dtype.itemsize, shape=(capacity,))
+        recorder._bind()
+        return recorder
+
+    def _bind(self):
+        self.capacity = len(self.records)
+        # Field views, so that recording a frame allocates nothing
+        self._fields = {name: self.records[name] for name in history_dtype.names}
+
+    # Number of records written since the start (including overwritten ones)
+    @property
+    def count(self):
+        return int(self.header['count'][0])
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    # Record the current state of the Rover
+    def record(self, Rover):
+        count = self.count
+        row = count % self.capacity
+        fields = self._fields
+        fields['time'][row] = Rover.total_time
+        fields['pos'][row] = Rover.pos
+        fields['yaw'][row] = Rover.yaw
+        fields['pitch'][row] = Rover.pitch
+        fields['roll'][row] = Rover.roll
+        fields['vel'][row] = Rover.vel
+        fields['throttle'][row] = Rover.throttle
+        fields['brake'][row] = Rover.brake
+        fields['steer'][row] = Rover.steer
+        fields['mode'][row] = mode_codes.get(Rover.mode[-1], 255)
+        fields['nav_count'][row] = 0 if Rover.nav_summary is None else Rover.nav_summary.count
+        fields['sample_pixels'][row] = sum(rock.area for rock in Rover.rock_detections)
+        fields['samples_collected'][row] = Rover.samples_collected
+        fields['quality'][row] = 0 if Rover.governor is None else Rover.governor.level
+        # Publish the row once it is complete
+        self.header['count'] = count + 1
+
+    def flush(self):
+        if isinstance(self.records, np.memmap):
+            self.records.flush()
+            self.header.flush()
+
+    # The last n records in time order
+    def last(self, n):
+        count = self.count
+        n = min(n, count, self.capacity)
+        return self.records[np.arange(count - n, count) % self.capacity]
+
+    # The records of the last `seconds` seconds in time order
+    # The ring holds at most two time ordered segments, the newest one ending
+    # at the write index: the start of the window is searched in the segment
+    # holding it and only the rows of the window are returned (a view when
+    # they do not wrap around the end of the ring)
+    def window(self, seconds):
+        count = self.count
+        if count == 0:
+            return self.records[:0]
+        times = self._fields['time']
+        end = count % self.capacity or self.capacity
+        start_time = times[end - 1] - seconds
+        if count <= self.capacity or times[0] <= start_time:
+            # Within the newest segment, rows 0 to end
+            start = np.searchsorted(times[:end], start_time)
+            return self.records[start:end]
+        # Starts in the oldest segment, rows end to capacity
+        start = end + np.searchsorted(times[end:], start_time)
+        return np.concatenate((self.records[start:], self.records[:end]))
+
+    # Length of the path driven in the last `seconds` seconds (meters)
+    def distance_moved(self, seconds):
+        return path_length(self.window(seconds))
+
+    # Whether the rover drove less than `distance` meters in the last `seconds`
+    # seconds while throttling, False until the history covers `seconds`
+    def stalled(self, seconds, distance):
+        records = self.window(seconds)
+        if len(records) < 2 or records['time'][-1] - records['time'][0] < 0.9 * seconds:
+            return False
+        if np.mean(records['throttle']) <= 0:
+            return False
+        return path_length(records) < distance
+
+# Define a function to get the length of the path driven over records (meters)
+def path_length(records):
+    pos = records['pos']
+    return float(np.sum(np.hypot(*np.diff(pos, axis=0).T)))
+
+# Print the last records of a flight recorder file
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Show the rover flight recorder')
+    parser.add_argument('path', type=str, help='Flight recorder file.')
+    parser.add_argument('-n', type=int, default=20, help='Number of records to show.')
+    args = parser.parse_args()
+    recorder = FlightRecorder.open(args.path)
+    print('{} records written, {} kept'.format(recorder.count, len(recorder)))
+    for record in recorder.last(args.n):
+        print('t={:8.2f} pos=({:6.1f},{:6.1f}) yaw={:6.1f} vel={:5.2f} throttle={:4.2f} brake={:4.1f} '
+              'steer={:6.2f} mode={} nav={} rocks={} collected={} quality={}'.format(
+              record['time'], record['pos'][0], record['pos'][1], record['yaw'], record['vel'],
+              record['throttle'], record['brake'], record['steer'],
+              mode_names.get(int(record['mode']), '?'), record['nav_count'],
+              record['sample_pixels'], record['samples_collected'], record['quality']))
@@ -0,0 +1,70 @@
+from metrics import metrics
+
+# Perception settings of one quality level
+# roi: only classify the camera rows seen within the view range
+# warp_step: warp every warp_step-th row and column of the warped image
+# nav_stride: keep every nav_stride-th navigable and obstacle pixel
+# map_every: update the world map every map_every-th frame
+class QualityLevel():
+    def __init__(self, roi=False, warp_step=1, nav_stride=1, map_every=1):
+        self.roi = roi
+        self.warp_step = warp_step
+        self.nav_stride = nav_stride
+        self.map_every = map_every
+
+# Quality levels from full quality to the cheapest, each level keeps the
+# savings of the previous one and adds another
+full_quality = QualityLevel()
+quality_levels = (
+    full_quality,
+    QualityLevel(map_every=2),
+    QualityLevel(map_every=2, nav_stride=2),
+    QualityLevel(roi=True, map_every=2, nav_stride=2),
+    QualityLevel(roi=True, warp_step=2, map_every=2, nav_stride=2),
+)
+
+# Define a frame budget governor
+# The perception time of every frame is smoothed and compared with the
+# budget: above it the governor drops to the next cheaper quality level,
+# below restore_below * budget it goes back up one level. A level is held
+# for a few frames before degrading further and for longer before restoring,
+# so the level does not flap. The current level is published as the
+# quality_level gauge and recorded by the flight recorder.
+class FrameGovernor():
+    def __init__(self, budget=0.02, levels=quality_levels, smoothing=0.2,
+                 restore_below=0.5, degrade_hold=5, restore_hold=50):
+        self.budget = budget
+        self.levels = levels
+        self.smoothing = smoothing
+        self.restore_below = restore_below
+        self.degrade_hold = degrade_hold
+        self.restore_hold = restore_hold
+        self.level = 0
+        self.frame_time = 0.0
+        self._held = 0
+        self._frames = 0
+
+    @property
+    def quality(self):
+        return self.levels[self.level]
+
+    # Take in the perception time of a frame (seconds)
+    def observe(self, seconds):
+        self.frame_time += self.smoothing * (seconds - self.frame_time)
+        self._held += 1
+        if (self.frame_time > self.budget and self.level < len(self.levels) - 1
+                and self._held >= self.degrade_hold):
+            self._set_level(self.level + 1)
+        elif (self.frame_time < self.restore_below * self.budget and self.level > 0
+                and self._held >= self.restore_hold):
+            self._set_level(self.level - 1)
+
+    def _set_level(self, level):
+        self.level = level
+        self._held = 0
+        metrics.set_gauge('quality_level', level)
+
+    # Whether the world map is updated on this frame
+    def update_map(self):
+        self._frames += 1
+        return self._frames % self.quality.map_every == 0
@@ -0,0 +1,105 @@
+import threading
+import time
+import numpy as np
+
+from supporting_functions import JpegEncoder, render_output_images
+from metrics import metrics
+
+# Copy of the rover state needed to draw the display images
+# The worldmap and vision image are copied into buffers reused between
+# captures, so the renderer never reads arrays perception is writing to
+class RenderSnapshot():
+    def __init__(self, Rover):
+        self.worldmap = np.empty_like(Rover.worldmap)
+        self.vision_image = np.empty_like(Rover.vision_image)
+        self.map_view = Rover.map_view
+        # Map tiles changed since the last rendering
+        self.dirty_tiles = np.zeros_like(Rover.map_view.dirty_tiles)
+
+    def capture(self, Rover):
+        np.copyto(self.worldmap, Rover.worldmap)
+        np.copyto(self.vision_image, Rover.vision_image)
+        self.dirty_tiles |= Rover.map_view.take_tiles()
+        self.rock_registry = Rover.rock_registry
+        self.samples_pos = Rover.samples_pos
+        self.pos = tuple(Rover.pos)
+        self.yaw = Rover.yaw
+        self.total_time = Rover.total_time
+        self.samples_collected = Rover.samples_collected
+
+    def take_tiles(self):
+        tiles = self.dirty_tiles.copy()
+        self.dirty_tiles[:] = False
+        return tiles
+
+# Define a background renderer for the inset images
+# At most `rate` times per second submit() captures a snapshot of the rover,
+# which a worker thread draws and encodes. Captures made while the worker is
+# busy replace the pending one (their map changes are merged), the control
+# loop never waits on rendering and replies with the most recent encoding.
+class InsetRenderer():
+    def __init__(self, rate=5, encoder='pil'):
+        self.interval = 1 / rate
+        self.encoders = (JpegEncoder(encoder), JpegEncoder(encoder))
+        self._lock = threading.Condition()
+        self._pending = None
+        self._spare = None
+        self._last_capture = None
+        self._latest = (b'', b'')
+        self._version = 0
+        self._taken = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='inset-renderer', daemon=True)
+        self._thread.start()
+
+    # Capture the rover state for rendering if the rate allows it
+    def submit(self, Rover):
+        now = time.monotonic()
+        if self._last_capture is not None and now - self._last_capture < self.interval:
+            return False
+        self._last_capture = now
+        with self._lock:
+            snapshot = self._pending or self._spare or RenderSnapshot(Rover)
+            self._spare = None
+            snapshot.capture(Rover)
+            self._pending = snapshot
+            self._lock.notify()
+        return True
+
+    # Most recent finished encoding as JPEG bytes,
+    # empty bytes if it did not change since the last call
+    def take(self):
+        with self._lock:
+            if self._version == self._taken:
+                return b'', b''
+            self._taken = self._version
+            return self._latest
+
+    # Most recent finished encoding as JPEG bytes
+    def latest(self):
+        with self._lock:
+            return self._latest
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self._lock.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._pending is None and self._running:
+                    self._lock.wait()
+                if not self._running:
+                    return
+                snapshot, self._pending = self._pending, None
+                dirty_tiles = snapshot.take_tiles()
+            with metrics.timer('create_output_images'):
+                map_add, vision_image = render_output_images(snapshot, dirty_tiles)
+                jpeg1 = self.encoders[0].encode(map_add)
+                jpeg2 = self.encoders[1].encode(vision_image)
+            with self._lock:
+                self._latest = (jpeg1, jpeg2)
+                self._version += 1
+                self._spare = snapshot
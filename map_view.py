@@ -0,0 +1,96 @@
+import numpy as np
+import cv2
+
+# Define the map view displayed on the right side of the screen
+# The static ground truth masks and the blended ground truth base image are
+# computed once. The view subscribes to the occupancy grid and perception_step
+# updates it every frame: the mapped / fidelity counters are updated from the
+# cells touched and their tiles are marked dirty, rendering only redraws the
+# dirty tiles. The cost of a frame follows the amount of change rather than
+# the map area, and the statistics are current whether images are rendered
+# or not.
+class MapView():
+    def __init__(self, ground_truth, occupancy, tile_size=20):
+        self.ground_truth = ground_truth
+        self.tile_size = tile_size
+        self.dirty_cells = occupancy.subscribe()
+        rows, cols = ground_truth.shape[:2]
+        # Ground truth navigable terrain and its (constant) total number of pixels
+        self.truth_nav = ground_truth[:,:,1] > 0
+        self.tot_map_pix = int(np.count_nonzero(self.truth_nav))
+        # Ground truth at half intensity, the plot map is added on top of it
+        self.base = cv2.addWeighted(np.zeros_like(ground_truth), 1, ground_truth, 0.5, 0)
+        self.plotmap = np.zeros_like(ground_truth)
+        self.map_add = self.base.copy()
+        # Cells shown as navigable terrain and the statistics on them
+        self.mapped = np.zeros((rows, cols), dtype=np.bool_)
+        self.tot_nav_pix = 0
+        self.good_nav_pix = 0
+        self.dirty_tiles = np.ones((-(-rows // tile_size), -(-cols // tile_size)), dtype=np.bool_)
+
+    # Render everything again on the next frame, e.g. after the worldmap was replaced
+    def invalidate(self, worldmap):
+        self.dirty_cells.drain()
+        self.mapped[:] = worldmap[:,:,2] > 0
+        self.tot_nav_pix = int(np.count_nonzero(self.mapped))
+        self.good_nav_pix = int(np.count_nonzero(self.mapped & self.truth_nav))
+        self.dirty_tiles[:] = True
+
+    # Take in the cells touched since the last update
+    # (or the given flat cells, drained from the subscription by the caller)
+    def update(self, worldmap, cells=None):
+        if cells is None:
+            cells = self.dirty_cells.drain()
+        if len(cells) == 0:
+            return
+        ys, xs = np.divmod(cells, worldmap.shape[1])
+        mapped = worldmap[ys, xs, 2] > 0
+        was_mapped = self.mapped[ys, xs]
+        # Cells that changed from/to navigable terrain
+        gained = mapped & ~was_mapped
+        lost = was_mapped & ~mapped
+        truth = self.truth_nav[ys, xs]
+        self.tot_nav_pix += int(np.count_nonzero(gained)) - int(np.count_nonzero(lost))
+        self.good_nav_pix += int(np.count_nonzero(gained & truth)) - int(np.count_nonzero(lost & truth))
+        self.mapped[ys, xs] = mapped
+        self.dirty_tiles[ys // self.tile_size, xs // self.tile_size] = True
+
+    # Take the tiles marked dirty since the last call, as a mask of tiles
+    def take_tiles(self):
+        tiles = self.dirty_tiles.copy()
+        self.dirty_tiles[:] = False
+        return tiles
+
+    # Re-render the given tiles (the tiles taken from the view when None)
+    # and return the blended map (not flipped, no overlays)
+    def render(self, worldmap, tiles=None):
+        if tiles is None:
+            tiles = self.take_tiles()
+        size = self.tile_size
+        for ty, tx in np.argwhere(tiles):
+            tile = np.s_[ty*size:(ty+1)*size, tx*size:(tx+1)*size]
+            navigable = worldmap[tile][:,:,2]
+            obstacle = worldmap[tile][:,:,0]
+            plotmap = self.plotmap[tile]
+            # Cells where navigable terrain is as likely as obstacles are navigable
+            plotmap[:,:,0] = np.where(obstacle > navigable, obstacle, 0)
+            plotmap[:,:,2] = navigable
+            self.map_add[tile] = cv2.add(plotmap, self.base[tile])
+        return self.map_add
+
+    # Percentage of the ground truth map that has been successfully found
+    @property
+    def perc_mapped(self):
+        return round(100*self.good_nav_pix/self.tot_map_pix, 1)
+
+    # Number of good map pixel detections divided by total pixels
+    # found to be navigable terrain
+    @property
+    def fidelity(self):
+        if self.tot_nav_pix > 0:
+            return round(100*self.good_nav_pix/self.tot_nav_pix, 1)
+        return 0
+
+    @property
+    def bad_nav_pix(self):
+        return self.tot_nav_pix - self.good_nav_pix
@@ -0,0 +1,134 @@
+import math
+import time
+import threading
+import logging
+from contextlib import contextmanager
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Define a latency histogram with log spaced buckets
+# Observing a latency is O(1) and the percentiles are read from the bucket
+# counts, accurate to a bucket width (about 12% with 20 buckets per decade)
+class LatencyHistogram():
+    def __init__(self, low=1e-6, high=100.0, buckets_per_decade=20):
+        self.low = low
+        self.buckets_per_decade = buckets_per_decade
+        decades = math.log10(high / low)
+        self.nbuckets = int(math.ceil(decades * buckets_per_decade))
+        # Upper edge of every bucket, the last bucket collects everything above high
+        self.edges = low * 10 ** (np.arange(1, self.nbuckets + 1) / buckets_per_decade)
+        self.counts = np.zeros(self.nbuckets + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        if seconds <= self.low:
+            bucket = 0
+        else:
+            bucket = min(int(math.log10(seconds / self.low) * self.buckets_per_decade), self.nbuckets)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Latency below which q percent of the observations fall
+    def percentile(self, q):
+        if self.count == 0:
+            return 0.0
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.count))
+        if bucket >= self.nbuckets:
+            return self.max
+        return min(float(self.edges[bucket]), self.max)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+# Define a registry of latency histograms, counters and gauges
+class Metrics():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.monotonic()
+
+    # Record a latency in seconds
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    # Time the enclosed block with the monotonic clock
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def increment(self, name, count=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    # Everything measured so far, latencies in seconds
+    def snapshot(self):
+        with self._lock:
+            return {
+                'uptime': time.monotonic() - self.started,
+                'latency': {name: histogram.summary() for name, histogram in self.histograms.items()},
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+
+    # One line summary, latencies in milliseconds
+    def summary_line(self):
+        snapshot = self.snapshot()
+        parts = ['{}={}'.format(name, value) for name, value in sorted(snapshot['counters'].items())]
+        parts += ['{}={}'.format(name, value) for name, value in sorted(snapshot['gauges'].items())]
+        for name, latency in sorted(snapshot['latency'].items()):
+            parts.append('{} p50/p95/p99={:.1f}/{:.1f}/{:.1f}ms'.format(
+                name, latency['p50'] * 1000, latency['p95'] * 1000, latency['p99'] * 1000))
+        return ' '.join(parts)
+
+# Define a periodic metrics summary, logged every `interval` seconds
+# The frames per second gauge is derived from the `frames` counter
+class MetricsReporter():
+    def __init__(self, metrics, interval=10.0):
+        self.metrics = metrics
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-reporter', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        last_frames = self.metrics.counters.get('frames', 0)
+        last_time = time.monotonic()
+        while not self._stop.wait(self.interval):
+            frames = self.metrics.counters.get('frames', 0)
+            now = time.monotonic()
+            self.metrics.set_gauge('fps', round((frames - last_frames) / (now - last_time), 1))
+            last_frames, last_time = frames, now
+            logger.info(self.metrics.summary_line())
+
+# Metrics of this process
+metrics = Metrics()
@@ -0,0 +1,100 @@
+import numpy as np
+
+# Cells of the occupancy grid touched since a subscriber last drained them
+# Every max_pending updates the pending cells are merged, so a subscriber
+# that is rarely drained holds each grid cell at most once
+class DirtyCells():
+    def __init__(self, max_pending=64):
+        self.max_pending = max_pending
+        self._pending = []
+
+    def add(self, cells):
+        self._pending.append(cells)
+        if len(self._pending) >= self.max_pending:
+            self._pending = [np.unique(np.concatenate(self._pending))]
+
+    # Return the flat indices of the touched cells and start over
+    def drain(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return np.empty(0, dtype=np.intp)
+        return np.unique(np.concatenate(pending))
+
+# Define an occupancy grid keeping per-cell hit counts of every class
+# Channels follow Rover.worldmap: 0 obstacles, 1 rock samples, 2 navigable terrain.
+# Rover.worldmap is kept up to date as the uint8 confidence view of the counts
+# (count * increment, saturated at 255) and only the cells observed in a frame
+# are touched, so the update cost follows the number of observed pixels.
+class OccupancyGrid():
+    def __init__(self, worldmap, increment=10, counts=None):
+        self.worldmap = worldmap
+        self.increment = increment
+        if counts is None:
+            counts = np.zeros(worldmap.shape, dtype=np.uint16)
+        self.counts = counts
+        self._subscribers = []
+
+    # Get notified of the cells touched by the next updates
+    def subscribe(self):
+        dirty = DirtyCells()
+        self._subscribers.append(dirty)
+        return dirty
+
+    # Add one hit per world pixel, given as (x_world, y_world) arrays for each class
+    # Returns the flat indices of the cells touched by this update
+    def update(self, obstacle_world, rock_world, navigable_world):
+        size = self.counts.shape[1]
+        flat_counts = self.counts.reshape(-1, 3)
+        flat_map = self.worldmap.reshape(-1, 3)
+        touched = []
+        for channel, (x_world, y_world) in enumerate((obstacle_world, rock_world, navigable_world)):
+            if len(x_world) == 0:
+                continue
+            # Accumulate the hits of this frame per cell then saturate
+            cells, hits = np.unique(y_world * size + x_world, return_counts=True)
+            counts = np.minimum(flat_counts[cells, channel] + hits, np.iinfo(self.counts.dtype).max)
+            flat_counts[cells, channel] = counts
+            flat_map[cells, channel] = np.minimum(counts * self.increment, 255)
+            touched.append(cells)
+        if not touched:
+            return np.empty(0, dtype=np.intp)
+        cells = np.unique(np.concatenate(touched))
+        # Navigable terrain overrides obstacles, only on the cells touched this frame
+        likely_nav = flat_counts[cells, 2] > 0
+        flat_map[cells[likely_nav], 0] = 0
+        for dirty in self._subscribers:
+            dirty.add(cells)
+        return cells
+
+    # Add hits counted elsewhere, given as an array shaped like the counts
+    # (see batch_mapping.py), same result as the frame by frame updates
+    # Returns the flat indices of the cells touched
+    def accumulate(self, hits):
+        flat_counts = self.counts.reshape(-1, 3)
+        flat_map = self.worldmap.reshape(-1, 3)
+        hits = hits.reshape(-1, 3)
+        cells = np.flatnonzero(hits.any(axis=1))
+        counts = np.minimum(flat_counts[cells].astype(np.int64) + hits[cells],
+                            np.iinfo(self.counts.dtype).max)
+        flat_counts[cells] = counts
+        flat_map[cells] = np.minimum(counts * self.increment, 255)
+        # Navigable terrain overrides obstacles
+        flat_map[cells[counts[:, 2] > 0], 0] = 0
+        for dirty in self._subscribers:
+            dirty.add(cells)
+        return cells
+
+    # Replace the hit counts, e.g. with counts restored from a checkpoint
+    # The worldmap is rebuilt from them and every counted cell is reported to
+    # the subscribers as touched. Returns the flat indices of those cells
+    def load(self, counts):
+        self.counts = counts
+        flat_counts = counts.reshape(-1, 3)
+        flat_map = self.worldmap.reshape(-1, 3)
+        flat_map[:] = np.minimum(flat_counts.astype(np.int64) * self.increment, 255)
+        # Navigable terrain overrides obstacles
+        flat_map[flat_counts[:, 2] > 0, 0] = 0
+        cells = np.flatnonzero(flat_counts.any(axis=1))
+        for dirty in self._subscribers:
+            dirty.add(cells)
+        return cells
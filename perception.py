@@ -1,6 +1,8 @@
 import cv2
 import numpy as np
 
+from governor import full_quality
+
 # Identify pixels above the threshold
 # Threshold of RGB > 160 does a nice job of identifying ground pixels only
 def color_thresh(img, rgb_thresh=(160, 160, 160)):
@@ -17,14 +19,87 @@ def color_thresh(img, rgb_thresh=(160, 160, 160)):
     # Return the binary image
     return color_select
 
+# Class labels produced by the color classifier
+# Obstacles and rocks share the lowest bit so (label & OBSTACLE) selects
+# everything that is not navigable, UNKNOWN is left outside the field of view
+UNKNOWN = 0
+OBSTACLE = 1
+NAVIGABLE = 2
+ROCK = 3
+
+# Lookup table color classifier
+# Every RGB color quantized to `bits` bits per channel is classified once with
+# color_thresh and the HSV rock bounds, after which a camera frame is labelled
+# with a single table lookup per pixel. bits=8 gives an exact (16MB) table.
+class ColorClassifier():
+    def __init__(self, rgb_thresh=(160, 160, 160), rock_lower=(24 - 5, 100, 100),
+                 rock_upper=(24 + 5, 255, 255), bits=6):
+        self.params = None
+        self.lut = None
+        self._index = None
+        self._scratch = None
+        self.configure(rgb_thresh, rock_lower, rock_upper, bits)
+
+    # Rebuild the lookup table, only when the thresholds actually changed
+    def configure(self, rgb_thresh, rock_lower, rock_upper, bits=None):
+        if bits is None:
+            bits = self.params[3]
+        params = (tuple(rgb_thresh), tuple(rock_lower), tuple(rock_upper), bits)
+        if params == self.params:
+            return self
+        shift = 8 - bits
+        # Classify the center color of every quantization bin
+        values = (np.arange(1 << bits) << shift) + ((1 << shift) >> 1)
+        red, green, blue = np.meshgrid(values, values, values, indexing='ij')
+        palette = np.dstack((red.ravel(), green.ravel(), blue.ravel())).astype(np.uint8)
+        navigable = color_thresh(palette, rgb_thresh)
+        hsv = cv2.cvtColor(palette, cv2.COLOR_RGB2HSV)
+        rock_samples = cv2.inRange(hsv, np.array(rock_lower), np.array(rock_upper))
+        lut = np.full(palette.shape[1], OBSTACLE, dtype=np.uint8)
+        lut[navigable[0] > 0] = NAVIGABLE
+        lut[rock_samples[0] > 0] = ROCK
+        self.lut = lut
+        self.params = params
+        return self
+
+    # Label every pixel of an RGB image as OBSTACLE, NAVIGABLE or ROCK
+    def classify(self, img, out=None):
+        bits = self.params[3]
+        shift = 8 - bits
+        shape = img.shape[:-1]
+        if self._index is None or self._index.shape != shape:
+            self._index = np.empty(shape, dtype=np.uint32)
+            self._scratch = np.empty(shape, dtype=np.uint32)
+        index, scratch = self._index, self._scratch
+        # index = (r >> shift) << 2*bits | (g >> shift) << bits | (b >> shift)
+        np.right_shift(img[..., 0], shift, out=index)
+        for channel in (1, 2):
+            np.left_shift(index, bits, out=index)
+            np.right_shift(img[..., channel], shift, out=scratch)
+            np.bitwise_or(index, scratch, out=index)
+        if out is None:
+            out = np.empty(shape, dtype=np.uint8)
+        return np.take(self.lut, index, out=out)
+
+# Color classifier for the last thresholds seen
+_classifier = None
+
+# Define a function to get the color classifier, its lookup
+# table is only rebuilt when the thresholds change
+def get_classifier(rgb_thresh, rock_lower, rock_upper):
+    global _classifier
+    if _classifier is None:
+        _classifier = ColorClassifier(rgb_thresh, rock_lower, rock_upper)
+    return _classifier.configure(rgb_thresh, rock_lower, rock_upper)
+
 # Define a function to convert from image coords to rover coords
 def rover_coords(binary_img):
     # Identify nonzero pixels
     ypos, xpos = binary_img.nonzero()
     # Calculate pixel positions with reference to the rover position being at the 
     # center bottom of the image.  
-    x_pixel = -(ypos - binary_img.shape[0]).astype(np.float)
-    y_pixel = -(xpos - binary_img.shape[1]/2 ).astype(np.float)
+    x_pixel = -(ypos - binary_img.shape[0]).astype(float)
+    y_pixel = -(xpos - binary_img.shape[1]/2 ).astype(float)
     return x_pixel, y_pixel
 
 
@@ -69,102 +144,305 @@ def pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale):
     # Return the result
     return x_pix_world, y_pix_world
 
+# Calibration box in source (actual) camera coordinates
+# These points were picked on the grid calibration image
+calib_source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
+
+# Define a function to build the calibration box in source and destination coordinates
+# The destination points are chosen to warp the image to a grid where each
+# 10x10 pixel square represents 1 square meter, the destination box will be
+# 2*dst_size on each side. The bottom offset accounts for the fact that the
+# bottom of the image is not the position of the rover but a bit in front of it
+def calibration_points(shape, dst_size=5, bottom_offset=6, source=calib_source):
+    destination = np.float32([[shape[1]/2 - dst_size, shape[0] - bottom_offset],
+                  [shape[1]/2 + dst_size, shape[0] - bottom_offset],
+                  [shape[1]/2 + dst_size, shape[0] - 2*dst_size - bottom_offset],
+                  [shape[1]/2 - dst_size, shape[0] - 2*dst_size - bottom_offset],
+                  ])
+    return source, destination
+
+# Perspective transform calibrated once per camera geometry
+# Holds the transform matrix and the remap tables of cv2.warpPerspective:
+# float maps of the source position of every warped pixel, computed in
+# float32 as cv2 does, and the nearest neighbour map cv2.convertMaps rounds
+# them to. The warps match cv2.warpPerspective up to float rounding, about
+# 1 pixel in 15000 differs (by one level with linear interpolation).
+class WarpContext():
+    def __init__(self, shape, src, dst):
+        self.shape = tuple(shape[:2])
+        self.src = np.float32(src)
+        self.dst = np.float32(dst)
+        self.M = cv2.getPerspectiveTransform(self.src, self.dst)
+        # Map every destination pixel back to its position in the camera image
+        M = np.linalg.inv(self.M).astype(np.float32)
+        ys, xs = np.indices(self.shape, dtype=np.float32)
+        w = M[2, 0]*xs + M[2, 1]*ys + M[2, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            map_x = (M[0, 0]*xs + M[0, 1]*ys + M[0, 2]) / w
+            map_y = (M[1, 0]*xs + M[1, 1]*ys + M[1, 2]) / w
+        # Pixels on the horizon line (w == 0) are sent outside of the image
+        horizon = ~(np.isfinite(map_x) & np.isfinite(map_y))
+        map_x[horizon] = -1
+        map_y[horizon] = -1
+        self.map_x = map_x
+        self.map_y = map_y
+        # Nearest neighbour lookups read the closest source pixel
+        self.nearest_map, _ = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2, nninterpolation=True)
+        # Decimated copies of the maps, built on first use
+        self._maps = {}
+
+    def matches(self, shape, src, dst):
+        return (tuple(shape[:2]) == self.shape
+                and np.array_equal(np.float32(src), self.src)
+                and np.array_equal(np.float32(dst), self.dst))
+
+    # keep same size as input image, or warp every step-th row and column only
+    def warp(self, img, interpolation=cv2.INTER_LINEAR, dst=None, step=1):
+        if interpolation == cv2.INTER_NEAREST:
+            return cv2.remap(img, self._decimated('nearest_map', step), None, interpolation,
+                             dst=dst, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        return cv2.remap(img, self._decimated('map_x', step), self._decimated('map_y', step),
+                         interpolation, dst=dst, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def _decimated(self, name, step):
+        if step == 1:
+            return getattr(self, name)
+        if (name, step) not in self._maps:
+            self._maps[name, step] = np.ascontiguousarray(getattr(self, name)[::step, ::step])
+        return self._maps[name, step]
+
+    # First camera row read by the nearest neighbour warp, only counting the
+    # warped pixels closer than view_range when given. Rows above it can be
+    # left unclassified.
+    def source_top(self, view_range=None):
+        if ('top', view_range) not in self._maps:
+            rows, cols = self.shape
+            source_x, source_y = self.nearest_map[..., 0], self.nearest_map[..., 1]
+            used = (source_x >= 0) & (source_x < cols) & (source_y >= 0) & (source_y < rows)
+            if view_range is not None:
+                ys, xs = np.indices(self.shape)
+                used &= (rows - ys)**2 + (cols/2 - xs)**2 < view_range**2
+            self._maps['top', view_range] = int(source_y[used].min()) if used.any() else rows
+        return self._maps['top', view_range]
+
+# Warp context of the last camera geometry seen
+_warp_context = None
+
+# Define a function to get the warp context, it is only rebuilt
+# when the image shape or the calibration points change
+def get_warp_context(shape, src, dst):
+    global _warp_context
+    if _warp_context is None or not _warp_context.matches(shape, src, dst):
+        _warp_context = WarpContext(shape, src, dst)
+    return _warp_context
+
 # Define a function to perform a perspective transform
 def perspect_transform(img, src, dst):
-           
-    M = cv2.getPerspectiveTransform(src, dst)
-    warped = cv2.warpPerspective(img, M, (img.shape[1], img.shape[0]))# keep same size as input image
+    # keep same size as input image
+    warped = get_warp_context(img.shape, src, dst).warp(img)
     
     return warped
 
 def impose_range(xpix, ypix, range=80):
-    dist = np.sqrt(xpix**2 + ypix**2)
-    return xpix[dist < range], ypix[dist < range]
-
-def find_yellow_rocks(img, rgb_thresh=(110, 110, 50)):
-    # Apply a threshold to identify yellow rocks
-    yellow_select = np.zeros_like(img[:,:,0])
-    yellow_thresh = (img[:,:,0] > rgb_thresh[0]) \
-                  & (img[:,:,1] > rgb_thresh[1]) \
-                  & (img[:,:,2] < rgb_thresh[2])
-    yellow_select[yellow_thresh] = 1
-    return yellow_select
-    
+    in_range = xpix**2 + ypix**2 < range**2
+    return xpix[in_range], ypix[in_range]
+
+# Rover-centric geometry of every pixel of the warped image
+# For a given image shape the rover coords, polar coords and range flag of
+# each pixel never change, so they are computed once as flat arrays and each
+# frame only gathers the entries at the flat indices of its nonzero pixels
+# With step > 1 the tables cover every step-th row and column of the image
+# (see WarpContext.warp), in the rover coords of the full size image
+class RoverGeometry():
+    def __init__(self, shape, view_range=80, step=1):
+        self.shape = tuple(shape[:2])
+        self.view_range = view_range
+        self.step = step
+        ypos, xpos = np.indices(self.shape)[:, ::step, ::step]
+        self.x_pixel = -(ypos.ravel() - self.shape[0]).astype(np.float32)
+        self.y_pixel = -(xpos.ravel() - self.shape[1]/2).astype(np.float32)
+        self.dists, self.angles = to_polar_coords(self.x_pixel, self.y_pixel)
+        # Pixels close enough to be trusted, in image layout for masking
+        self.in_range = (self.dists < view_range).reshape(ypos.shape)
+
+    def matches(self, shape, view_range, step=1):
+        return (tuple(shape[:2]) == self.shape and view_range == self.view_range
+                and step == self.step)
+
+    # Flat indices of the nonzero pixels of a mask
+    # Masks are limited to the view range with np.logical_and(mask, in_range)
+    def indices(self, mask):
+        return np.flatnonzero(mask)
+
+# Rover geometry of the last warped image shape seen
+_geometry = None
+
+# Define a function to get the rover geometry tables, they
+# are only rebuilt when the image shape, view range or step change
+def get_geometry(shape, view_range=80, step=1):
+    global _geometry
+    if _geometry is None or not _geometry.matches(shape, view_range, step):
+        _geometry = RoverGeometry(shape, view_range, step)
+    return _geometry
+
+# One rock sample seen in the warped image
+# Position of the centroid of its pixels in rover coords and polar coords,
+# number of pixels and position in the world map
+class RockDetection():
+    def __init__(self, x_pixel, y_pixel, area, x_world, y_world):
+        self.x_pixel = x_pixel
+        self.y_pixel = y_pixel
+        self.area = area
+        self.distance, self.bearing = to_polar_coords(x_pixel, y_pixel)
+        self.x_world = x_world
+        self.y_world = y_world
+
+# Define a function to detect the rock samples of a warped rock mask
+# Connected pixels make one rock, rocks of less than min_area pixels are
+# noise. The world position of each rock is the one of its centroid.
+# A mask warped with step > 1 is scaled back to full size pixels.
+def detect_rocks(rock_mask, xpos, ypos, yaw, world_size, scale, min_area=2, step=1):
+    count, _, stats, centroids = cv2.connectedComponentsWithStats(
+        rock_mask.view(np.uint8), connectivity=8)
+    # Label 0 is the background
+    areas = stats[1:, cv2.CC_STAT_AREA] * step**2
+    keep = np.flatnonzero(areas >= min_area)
+    if len(keep) == 0:
+        return []
+    rows, cols = rock_mask.shape
+    x_pixel = (rows - centroids[keep + 1, 1]) * step
+    y_pixel = (cols / 2 - centroids[keep + 1, 0]) * step
+    x_world, y_world = pix_to_world(x_pixel, y_pixel, xpos, ypos, yaw, world_size, scale)
+    return [RockDetection(*values) for values in zip(x_pixel.tolist(), y_pixel.tolist(),
+                                                     areas[keep].tolist(),
+                                                     x_world.tolist(), y_world.tolist())]
+
+# Fixed size summary of the navigable terrain in rover space
+# Navigable pixels are binned by angle (angle_bins over +/- 90 degrees) and
+# distance (range_bins over the view range). counts holds the number of pixels
+# per bin and weights the sum of their distances, so far open terrain weighs
+# more than the ground right in front of the rover. The count, mean and
+# standard deviation of the angles are kept exactly so decisions made on the
+# summary match the ones made on the per-pixel arrays.
+class PolarHistogram():
+    def __init__(self, geometry, angle_bins=18, range_bins=8):
+        self.geometry = geometry
+        self.shape = (angle_bins, range_bins)
+        self.angle_edges = np.linspace(-np.pi/2, np.pi/2, angle_bins + 1)
+        self.range_edges = np.linspace(0, geometry.view_range, range_bins + 1)
+        # Bin of every pixel of the warped image, computed once per geometry
+        angle_bin = np.clip(np.digitize(geometry.angles, self.angle_edges) - 1, 0, angle_bins - 1)
+        range_bin = np.clip(np.digitize(geometry.dists, self.range_edges) - 1, 0, range_bins - 1)
+        self.bins = angle_bin * range_bins + range_bin
+        self.counts = np.zeros(self.shape, dtype=np.int64)
+        self.weights = np.zeros(self.shape)
+        self.count = 0
+        self.mean_angle = 0.0
+        self.std_angle = 0.0
+
+    def matches(self, geometry, angle_bins=18, range_bins=8):
+        return geometry is self.geometry and self.shape == (angle_bins, range_bins)
+
+    # Summarize the pixels at the given flat indices of the geometry tables,
+    # each one standing for `weight` pixels when the pixels were subsampled
+    def update(self, indices, weight=1):
+        bins = self.bins[indices]
+        size = self.counts.size
+        self.counts = np.bincount(bins, minlength=size).reshape(self.shape) * weight
+        self.weights = np.bincount(bins, weights=self.geometry.dists[indices],
+                                   minlength=size).reshape(self.shape) * weight
+        self.count = len(indices) * weight
+        if self.count == 0:
+            self.mean_angle = self.std_angle = 0.0
+            return self
+        angles = self.geometry.angles[indices].astype(np.float64)
+        self.mean_angle = angles.mean()
+        self.std_angle = np.sqrt(max(np.dot(angles, angles) / len(angles) - self.mean_angle**2, 0))
+        return self
+
+    # Centers of the angle bins in radians
+    def angle_centers(self):
+        return (self.angle_edges[:-1] + self.angle_edges[1:]) / 2
+
 def perception_step(Rover):
     # Perform perception steps to update Rover()
     # TODO: 
     # NOTE: camera image is coming to you in Rover.img
     img = Rover.img
+        # Settings of the current quality level when a frame budget governor
+        # trades quality for latency
+    quality = full_quality if Rover.governor is None else Rover.governor.quality
+    step = quality.warp_step
     # 1) Define source and destination points for perspective transform
-     # Define calibration box in source (actual) and destination (desired) coordinates
-        # These source and destination points are defined to warp the image
-        # to a grid where each 10x10 pixel square represents 1 square meter
-        # The destination box will be 2*dst_size on each side
-    dst_size = 5
-        # Set a bottom offset to account for the fact that the bottom of the image
-        # is not the position of the rover but a bit in front of it
-        # this is just a rough guess, feel free to change it!
-    bottom_offset = 6
-    source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
-    destination = np.float32([[img.shape[1]/2 - dst_size, img.shape[0] - bottom_offset],
-                  [img.shape[1]/2 + dst_size, img.shape[0] - bottom_offset],
-                  [img.shape[1]/2 + dst_size, img.shape[0] - 2*dst_size - bottom_offset],
-                  [img.shape[1]/2 - dst_size, img.shape[0] - 2*dst_size - bottom_offset],
-                  ])
-    # 2) Apply perspective transform
-    warped = perspect_transform(img, source, destination)
-
-    # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
-    navigable = color_thresh(warped)
-        # ignore half of the image as bad data
-    # navigable[0:int(navigable.shape[0]/2), 🙂 = 0
-
-        # Obstacles are simply navigable inverted
-    mask = np.ones_like(navigable)
-    mask[:,:] = 255
-    mask = perspect_transform(mask, source, destination)
-    obstacles = np.absolute((np.float32(navigable)-1) * mask)
-        # ignore half of the image as bad data
-    # obstacles[0:int(obstacles.shape[0]/2),:] = 0
-
-        # identify the rock
-    lower_yellow = np.array([24 - 5, 100, 100])
-    upper_yellow = np.array([24 + 5, 255, 255])
-            # Convert BGR to HSV
-    hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)
-            # Threshold the HSV image to get only upper_yellow colors
-    rock_samples = cv2.inRange(hsv, lower_yellow, upper_yellow)
-    rock_samples = perspect_transform(rock_samples, source, destination)
+        # The calibration box only changes with the image shape or the
+        # Rover.dst_size and Rover.bottom_offset settings, in which case
+        # the cached warp context is rebuilt
+    source, destination = calibration_points(img.shape, Rover.dst_size, Rover.bottom_offset)
+    warp = get_warp_context(img.shape, source, destination)
+    # 2) Apply color threshold to identify navigable terrain/obstacles/rock samples
+        # A single lookup table pass labels every camera pixel, the lookup
+        # table is only rebuilt when Rover.nav_thresh or the rock bounds change
+        # Only the camera rows read by the warp are classified (the ones seen
+        # within the view range with the roi quality setting)
+    classifier = get_classifier(Rover.nav_thresh, Rover.rock_lower, Rover.rock_upper)
+    top = warp.source_top(Rover.view_range if quality.roi else None)
+    Rover.camera_labels[:top] = UNKNOWN
+    classifier.classify(img[top:], out=Rover.camera_labels[top:])
+
+    # 3) Apply perspective transform
+        # Warp the label image once, pixels outside of the field of view are UNKNOWN
+        # All the images below are preallocated on Rover and written in place,
+        # decimated warps (warp_step quality setting) get smaller images
+    if step == 1:
+        buffers = (Rover.warped_labels, Rover.navigable_mask, Rover.obstacles_mask, Rover.rocks_mask)
+    else:
+        buffers = (None, None, None, None)
+    labels = warp.warp(Rover.camera_labels, interpolation=cv2.INTER_NEAREST,
+                       dst=buffers[0], step=step)
+    navigable = np.equal(labels, NAVIGABLE, out=buffers[1])
+        # Obstacles are everything in view that is not navigable (rocks included)
+    obstacles = np.bitwise_and(labels, OBSTACLE, out=buffers[2]).view(np.bool_)
+    rock_samples = np.equal(labels, ROCK, out=buffers[3])
 
     # 4) Update Rover.vision_image (this will be displayed on left side of screen)
         # Example: Rover.vision_image[:,:,0] = obstacle color-thresholded binary image
         #          Rover.vision_image[:,:,1] = rock_sample color-thresholded binary image
         #          Rover.vision_image[:,:,2] = navigable terrain color-thresholded binary image
 
-    Rover.vision_image[:,:,0] = obstacles
-    Rover.vision_image[:,:,1] = rock_samples
-    Rover.vision_image[:,:,2] = navigable
-    idx = np.nonzero(Rover.vision_image)
-    Rover.vision_image[idx] = 255
+    for channel, mask in enumerate((obstacles, rock_samples, navigable)):
+        if step > 1:
+            mask = mask.repeat(step, axis=0).repeat(step, axis=1)
+        np.multiply(mask, np.uint8(255), out=Rover.vision_image[:,:,channel])
 
     # 5) Convert map image pixel values to rover-centric coords
-    xpix_navigable, ypix_navigable = rover_coords(navigable)
-    xpix_obstacles, ypix_obstacles = rover_coords(obstacles)
-    xpix_rocks, ypix_rocks = rover_coords(rock_samples)
+        # Look up the precomputed rover coords of the nonzero pixels, navigable
+        # and obstacle pixels are limited to Rover.view_range as they get less
+        # accurate farther away
+        # With the nav_stride quality setting only every nav_stride-th pixel is kept
+    geometry = get_geometry(img.shape, Rover.view_range, step)
+    stride = quality.nav_stride
+    navigable_idx = geometry.indices(np.logical_and(navigable, geometry.in_range, out=navigable))[::stride]
+    obstacles_idx = geometry.indices(np.logical_and(obstacles, geometry.in_range, out=obstacles))[::stride]
+    xpix_navigable, ypix_navigable = geometry.x_pixel[navigable_idx], geometry.y_pixel[navigable_idx]
+    xpix_obstacles, ypix_obstacles = geometry.x_pixel[obstacles_idx], geometry.y_pixel[obstacles_idx]
 
     # 6) Convert rover-centric pixel values to world coordinates
     scale = 10.0
-    xpix_navigable, ypix_navigable = impose_range(xpix_navigable, ypix_navigable)
-    xpix_obstacles, ypix_obstacles = impose_range(xpix_obstacles, ypix_obstacles)
     navigable_x_world, navigable_y_world = pix_to_world(xpix_navigable, ypix_navigable,
                                                         Rover.pos[0], Rover.pos[1],
                                                         Rover.yaw, Rover.worldmap.shape[0], scale)
     obstacle_x_world, obstacle_y_world = pix_to_world(xpix_obstacles, ypix_obstacles,
                                                       Rover.pos[0], Rover.pos[1],
                                                       Rover.yaw, Rover.worldmap.shape[0], scale)
-    rock_x_world, rock_y_world = pix_to_world(xpix_rocks, ypix_rocks,
-                                              Rover.pos[0], Rover.pos[1],
-                                              Rover.yaw, Rover.worldmap.shape[0], scale)
+        # Rock samples are detected as connected blobs of rock pixels, each
+        # one is a single detection with a single world position
+    if rock_samples.any():
+        Rover.rock_detections = detect_rocks(rock_samples, Rover.pos[0], Rover.pos[1],
+                                             Rover.yaw, Rover.worldmap.shape[0], scale, step=step)
+    else:
+        Rover.rock_detections = []
+    rock_x_world = np.array([rock.x_world for rock in Rover.rock_detections], dtype=np.int_)
+    rock_y_world = np.array([rock.y_world for rock in Rover.rock_detections], dtype=np.int_)
 
     # 7) Update Rover worldmap (to be displayed on right side of screen)
         # Example: Rover.worldmap[obstacle_y_world, obstacle_x_world, 0] += 1
@@ -172,29 +450,39 @@ def perception_step(Rover):
         #          Rover.worldmap[navigable_y_world, navigable_x_world, 2] += 1
 
         # Only update map if pitch an roll are near zero
-    if (Rover.pitch < 1 or Rover.pitch > 359) and (Rover.roll < 1 or Rover.roll > 359):
-        # increment = 10
-        Rover.worldmap[obstacle_y_world, obstacle_x_world, 0] = 255
-        Rover.worldmap[rock_y_world, rock_x_world,1] = 255
-        Rover.worldmap[navigable_y_world, navigable_x_world, 2] = 255
-            # remove overlap mesurements
-        nav_pix = Rover.worldmap[:, :, 2] > 0
-        Rover.worldmap[nav_pix, 0] = 0
-            # clip to avoid overflow
-        Rover.worldmap = np.clip(Rover.worldmap, 0, 255)
+        # (and on every map_every-th frame only with the map_every quality setting)
+    flat = (Rover.pitch < 1 or Rover.pitch > 359) and (Rover.roll < 1 or Rover.roll > 359)
+    if flat and (Rover.governor is None or Rover.governor.update_map()):
+        # Hits are counted per cell by Rover.occupancy, which keeps the
+        # worldmap confidence view up to date and removes overlap
+        # mesurements (navigable terrain overrides obstacles) on the
+        # cells touched this frame only
+        Rover.occupancy.update((obstacle_x_world, obstacle_y_world),
+                               (rock_x_world, rock_y_world),
+                               (navigable_x_world, navigable_y_world))
+        # Match the new rock detections against the known sample positions
+        if Rover.rock_registry is not None:
+            Rover.rock_registry.observe(rock_x_world, rock_y_world)
+            Rover.samples_located = Rover.rock_registry.samples_located
+        # Keep the mapping statistics current, rendering only redraws
+        # the tiles this marks dirty
+        Rover.map_view.update(Rover.worldmap)
 
     # Convert rover-centric pixel positions to polar coordinates
     # Update Rover pixel distances and angles
         # Rover.nav_dists = rover_centric_pixel_distances
         # Rover.nav_angles = rover_centric_angles
+        # Polar coords are gathered from the precomputed tables as well
 
-    dist, angles = to_polar_coords(xpix_navigable, ypix_navigable)
-    Rover.nav_dists = dist
-    Rover.nav_angles = angles
-        # Same for rock samples
-    dist, angles = to_polar_coords(xpix_rocks, ypix_rocks)
-    Rover.samples_dists = dist
-    Rover.samples_angles = angles
+    Rover.nav_dists = geometry.dists[navigable_idx]
+    Rover.nav_angles = geometry.angles[navigable_idx]
+        # Constant size summary of the navigable terrain used by decision_step
+    if Rover.nav_summary is None or not Rover.nav_summary.matches(geometry):
+        Rover.nav_summary = PolarHistogram(geometry)
+    Rover.nav_summary.update(navigable_idx, weight=step**2 * stride)
+        # One entry per detected rock sample
+    Rover.samples_dists = np.array([rock.distance for rock in Rover.rock_detections])
+    Rover.samples_angles = np.array([rock.bearing for rock in Rover.rock_detections])
     return Rover
 
 
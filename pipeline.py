@@ -0,0 +1,193 @@
+import threading
+import time
+import queue
+import logging
+import numpy as np
+
+from perception import perception_step
+from decision import decision_step
+from supporting_functions import apply_telemetry
+from telemetry import TelemetryDecoder
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Define a single slot mailbox holding the latest value
+# put() replaces a value that was not taken yet, so a slow consumer always
+# gets the freshest value and old ones are dropped instead of queued
+class LatestMailbox():
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._value = None
+        self._full = False
+        self._closed = False
+        self.dropped = 0
+
+    # Store a value, returns the value it replaced (None if there was none)
+    def put(self, value):
+        with self._cond:
+            dropped = self._value if self._full else None
+            if self._full:
+                self.dropped += 1
+            self._value = value
+            self._full = True
+            self._cond.notify()
+            return dropped
+
+    # Wait for a value and take it, returns None once the mailbox is closed
+    def take(self):
+        with self._cond:
+            while not self._full and not self._closed:
+                self._cond.wait()
+            if not self._full:
+                return None
+            value, self._value, self._full = self._value, None, False
+            return value
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+# Commands decided for the latest frame
+class Commands():
+    def __init__(self, throttle=0, brake=0, steer=0, pickup=False):
+        self.throttle = throttle
+        self.brake = brake
+        self.steer = steer
+        self.pickup = pickup
+
+# Define a staged frame pipeline
+# Decoding, perception and decision run on their own worker threads and hand
+# frames to each other through latest-value mailboxes, rendering is done by
+# an InsetRenderer. OpenCV and NumPy release the GIL so the stages overlap.
+# Perception and decision both update the Rover, they take turns on its lock.
+# The socket handler only submits telemetry and replies at once with the
+# freshest commands.
+class FramePipeline():
+    def __init__(self, Rover, renderer=None, buffers=4):
+        self.Rover = Rover
+        self.renderer = renderer
+        self.state_lock = threading.Lock()
+        self.decoder = TelemetryDecoder()
+        # Camera image buffers: decoding, waiting in a mailbox, in use as Rover.img
+        self._free_images = queue.Queue()
+        for _ in range(buffers):
+            self._free_images.put(np.zeros_like(self.decoder.image))
+        self._rover_image = None
+        self.telemetry = LatestMailbox()
+        self.frames = LatestMailbox()
+        self.perceived = LatestMailbox()
+        self._commands_lock = threading.Lock()
+        self._commands = Commands()
+        self._threads = [threading.Thread(target=self._run, args=(stage,), name=stage.__name__, daemon=True)
+                         for stage in (self._decode, self._perceive, self._decide)]
+        for thread in self._threads:
+            thread.start()
+
+    # Hand over new telemetry data, never blocks
+    def submit(self, data):
+        self.telemetry.put(data)
+
+    # Commands for the most recent frame, the pickup request is only returned once
+    def commands(self):
+        with self._commands_lock:
+            commands = self._commands
+            if commands.pickup:
+                self._commands = Commands(commands.throttle, commands.brake, commands.steer)
+            return commands
+
+    # Frames dropped because a stage was still busy with an older one
+    @property
+    def dropped(self):
+        return self.telemetry.dropped + self.frames.dropped + self.perceived.dropped
+
+    def stop(self):
+        for mailbox in (self.telemetry, self.frames, self.perceived):
+            mailbox.close()
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, stage):
+        while True:
+            try:
+                if not stage():
+                    return
+            except Exception:
+                logger.exception('%s stage failed', stage.__name__)
+
+    def _image_buffer(self):
+        try:
+            return self._free_images.get_nowait()
+        except queue.Empty:
+            return np.zeros_like(self.decoder.image)
+
+    def _decode(self):
+        data = self.telemetry.take()
+        if data is None:
+            return False
+        image = self._image_buffer()
+        try:
+            with metrics.timer('decode'):
+                frame = self.decoder.decode(data, out=image)
+        except Exception:
+            self._free_images.put(image)
+            metrics.increment('invalid_frames')
+            raise
+        dropped = self.frames.put(frame)
+        if dropped is not None:
+            self._free_images.put(dropped.image)
+        return True
+
+    def _perceive(self):
+        frame = self.frames.take()
+        if frame is None:
+            return False
+        with self.state_lock:
+            apply_telemetry(self.Rover, frame)
+            # The previous camera image is no longer in use
+            if self._rover_image is not None:
+                self._free_images.put(self._rover_image)
+            self._rover_image = frame.image
+            if np.isfinite(self.Rover.vel):
+                start = time.perf_counter()
+                with metrics.timer('perception_step'):
+                    perception_step(self.Rover)
+                # The governor times perception only, as in the other modes
+                if self.Rover.governor is not None:
+                    self.Rover.governor.observe(time.perf_counter() - start)
+                valid = True
+            else:
+                valid = False
+        if valid:
+            self.perceived.put(frame)
+        else:
+            # In case of invalid telemetry, send null commands
+            metrics.increment('invalid_frames')
+            self._publish(Commands())
+        return True
+
+    def _decide(self):
+        frame = self.perceived.take()
+        if frame is None:
+            return False
+        with self.state_lock:
+            with metrics.timer('decision_step'):
+                Rover = decision_step(self.Rover)
+            # If in a state where want to pickup a rock send pickup command
+            pickup = Rover.send_pickup and not Rover.picking_up
+            if pickup:
+                Rover.send_pickup = False
+            commands = Commands(Rover.throttle, Rover.brake, Rover.steer, pickup)
+            if self.renderer is not None:
+                self.renderer.submit(Rover)
+            if Rover.checkpoint is not None:
+                Rover.checkpoint.submit(Rover)
+        self._publish(commands)
+        return True
+
+    def _publish(self, commands):
+        with self._commands_lock:
+            # Keep a pickup request that was not sent yet
+            commands.pickup = commands.pickup or self._commands.pickup
+            self._commands = commands
@@ -0,0 +1,307 @@
+import heapq
+import math
+import time
+import numpy as np
+
+# Coarse cell states of the costmap
+UNKNOWN = 0
+FREE = 1
+BLOCKED = 2
+
+# Cost of entering a cell of each state, unknown terrain is assumed to be
+# passable but explored terrain is preferred, blocked cells are never entered
+state_costs = np.array([3.0, 1.0, np.inf])
+# Extra cost of a cell next to a blocked one, keeps routes off the walls
+wall_cost = 2.0
+
+# 8-connected neighbourhood (dx, dy, step length)
+neighbours = [(dx, dy, math.hypot(dx, dy)) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+              if dx or dy]
+
+# Define a coarse costmap of the world map
+# Each cell covers cell_size x cell_size world map cells and is BLOCKED when
+# it holds more obstacle than navigable hits (as shown on the map view), FREE
+# when it holds navigable hits and UNKNOWN otherwise. The costmap subscribes
+# to the occupancy grid and only the cells touched since the last update are
+# recomputed. Frontiers (FREE cells next to UNKNOWN ones) are kept up to date
+# from the changed cells as well.
+class Costmap():
+    def __init__(self, occupancy, cell_size=2):
+        self.occupancy = occupancy
+        self.cell_size = cell_size
+        self.dirty_cells = occupancy.subscribe()
+        self.size = occupancy.counts.shape[0] // cell_size
+        self.state = np.zeros((self.size, self.size), dtype=np.uint8)
+        self.cost = np.full((self.size, self.size), state_costs[UNKNOWN])
+        self.frontiers = set()
+
+    # Take in the occupancy changes, returns the (x, y) cells whose cost changed
+    def update(self):
+        cells = self.dirty_cells.drain()
+        if len(cells) == 0:
+            return []
+        world_size = self.occupancy.counts.shape[1]
+        ys, xs = np.divmod(cells, world_size)
+        coarse = np.unique((ys // self.cell_size) * self.size + xs // self.cell_size)
+        cy, cx = np.divmod(coarse, self.size)
+        # Hit counts summed over the world map cells of each coarse cell
+        size, cs = self.size, self.cell_size
+        blocks = self.occupancy.counts[:size*cs, :size*cs].reshape(size, cs, size, cs, 3)
+        hits = blocks[cy, :, cx, :, :].sum(axis=(1, 2), dtype=np.int64)
+        state = np.where(hits[:, 0] > hits[:, 2], BLOCKED,
+                         np.where(hits[:, 2] > 0, FREE, UNKNOWN)).astype(np.uint8)
+        changed = state != self.state[cy, cx]
+        if not changed.any():
+            return []
+        cy, cx = cy[changed], cx[changed]
+        self.state[cy, cx] = state[changed]
+        # The cost and frontier flag of a cell depend on its neighbours
+        around = {(int(x) + dx, int(y) + dy) for x, y in zip(cx, cy)
+                  for dx in (-1, 0, 1) for dy in (-1, 0, 1)}
+        around = [(x, y) for x, y in around if 0 <= x < size and 0 <= y < size]
+        cost_changed = []
+        for x, y in around:
+            window = self.state[max(y-1, 0):y+2, max(x-1, 0):x+2]
+            cost = state_costs[self.state[y, x]]
+            if self.state[y, x] != BLOCKED and (window == BLOCKED).any():
+                cost += wall_cost
+            if cost != self.cost[y, x]:
+                self.cost[y, x] = cost
+                cost_changed.append((x, y))
+            if self.state[y, x] == FREE and (window == UNKNOWN).any():
+                self.frontiers.add((x, y))
+            else:
+                self.frontiers.discard((x, y))
+        return cost_changed
+
+    # Define functions to convert between world map and costmap coordinates
+    def cell(self, pos):
+        return (min(max(int(pos[0] // self.cell_size), 0), self.size - 1),
+                min(max(int(pos[1] // self.cell_size), 0), self.size - 1))
+
+    def center(self, cell):
+        return ((cell[0] + 0.5) * self.cell_size, (cell[1] + 0.5) * self.cell_size)
+
+# Define a D* Lite search from the rover (start) to a goal cell
+# The search runs from the goal towards the start, so when the rover moves
+# or cell costs change only the affected part of the search is redone.
+# compute() expands cells until the path is known or the deadline passes,
+# the search state is kept in between so it resumes on the next call.
+class DStarLite():
+    def __init__(self, costmap, start, goal):
+        self.costmap = costmap
+        self.start = start
+        self.goal = goal
+        self.last = start
+        self.km = 0.0
+        self.g = {}
+        self.rhs = {goal: 0.0}
+        self.queue = []
+        self.queued = {}
+        self._push(goal)
+
+    def _heuristic(self, a, b):
+        dx, dy = abs(a[0] - b[0]), abs(a[1] - b[1])
+        return max(dx, dy) + (math.sqrt(2) - 1) * min(dx, dy)
+
+    def _key(self, cell):
+        best = min(self.g.get(cell, math.inf), self.rhs.get(cell, math.inf))
+        return (best + self._heuristic(self.start, cell) + self.km, best)
+
+    def _push(self, cell):
+        key = self._key(cell)
+        self.queued[cell] = key
+        heapq.heappush(self.queue, (key, cell))
+
+    # Cost of moving from a cell to its neighbour, the goal is always enterable
+    def _cost(self, cell, step):
+        if cell == self.goal:
+            return step
+        return step * self.costmap.cost[cell[1], cell[0]]
+
+    def _successors(self, cell):
+        size = self.costmap.size
+        for dx, dy, step in neighbours:
+            x, y = cell[0] + dx, cell[1] + dy
+            if 0 <= x < size and 0 <= y < size:
+                yield (x, y), step
+
+    def _update_vertex(self, cell):
+        if cell != self.goal:
+            self.rhs[cell] = min((self._cost(succ, step) + self.g.get(succ, math.inf)
+                                  for succ, step in self._successors(cell)), default=math.inf)
+        self.queued.pop(cell, None)
+        if self.g.get(cell, math.inf) != self.rhs.get(cell, math.inf):
+            self._push(cell)
+
+    # Move the start to the rover's current cell
+    def move_start(self, start):
+        if start != self.start:
+            self.km += self._heuristic(self.last, start)
+            self.last = self.start = start
+
+    # Take in cells whose cost changed, the edges into them changed
+    def cells_changed(self, cells):
+        for cell in cells:
+            for pred, step in self._successors(cell):
+                self._update_vertex(pred)
+
+    # Expand cells until the start is consistent or the deadline passes
+    # Returns True when the search is complete
+    def compute(self, deadline):
+        g, rhs = self.g, self.rhs
+        expanded = 0
+        while self.queue:
+            key, cell = self.queue[0]
+            if self.queued.get(cell) != key:
+                # Stale entry of a cell updated or removed since
+                heapq.heappop(self.queue)
+                continue
+            start_key = self._key(self.start)
+            if key >= start_key and rhs.get(self.start, math.inf) == g.get(self.start, math.inf):
+                return True
+            expanded += 1
+            if expanded % 64 == 0 and time.perf_counter() > deadline:
+                return False
+            heapq.heappop(self.queue)
+            new_key = self._key(cell)
+            if key < new_key:
+                self._push(cell)
+            elif g.get(cell, math.inf) > rhs.get(cell, math.inf):
+                del self.queued[cell]
+                g[cell] = rhs[cell]
+                for pred, step in self._successors(cell):
+                    self._update_vertex(pred)
+            else:
+                del self.queued[cell]
+                g[cell] = math.inf
+                self._update_vertex(cell)
+                for pred, step in self._successors(cell):
+                    self._update_vertex(pred)
+        return True
+
+    @property
+    def reachable(self):
+        return self.g.get(self.start, math.inf) < math.inf
+
+    # Follow the search from the start to the goal, at most max_cells cells
+    def path(self, max_cells=50):
+        cells = []
+        cell = self.start
+        while cell != self.goal and len(cells) < max_cells:
+            best, best_cost = None, math.inf
+            for succ, step in self._successors(cell):
+                cost = self._cost(succ, step) + self.g.get(succ, math.inf)
+                if cost < best_cost:
+                    best, best_cost = succ, cost
+            if best is None or best in cells:
+                break
+            cells.append(best)
+            cell = best
+        return cells
+
+# Define a global planner
+# Keeps the costmap up to date from the occupancy grid and plans with D* Lite
+# towards, by priority: the closest located but uncollected rock sample, the
+# closest frontier while exploring, and the start position once every sample
+# was collected or the map is mapped enough (or nothing is left to explore).
+# update() fits in `budget` seconds per frame, an unfinished search resumes
+# on the next frame. A goal found unreachable is skipped for retry_frames
+# frames, the map around it may have changed by then. decision_step steers
+# towards waypoint().
+class Planner():
+    def __init__(self, occupancy, cell_size=2, budget=0.005, mapped_goal=95, lookahead=4,
+                 retry_frames=200):
+        self.costmap = Costmap(occupancy, cell_size)
+        self.budget = budget
+        self.mapped_goal = mapped_goal
+        self.lookahead = lookahead
+        self.retry_frames = retry_frames
+        self.frames = 0
+        self.home = None
+        self.goal = None
+        self.goal_kind = None
+        self.search = None
+        self.waypoints = []
+        self.collected = None
+        self.samples_collected = 0
+        # Goals found unreachable and the frame from which they are tried again
+        self.unreachable = {}
+        self.finished = False
+
+    # Update the costmap, goal and search for the current rover state
+    def update(self, Rover):
+        deadline = time.perf_counter() + self.budget
+        if Rover.pos is None:
+            return
+        if self.home is None:
+            self.home = tuple(Rover.pos)
+        self.frames += 1
+        if self.unreachable:
+            self.unreachable = {goal: retry for goal, retry in self.unreachable.items()
+                                if retry > self.frames}
+        changed = self.costmap.update()
+        self._track_samples(Rover)
+        start = self.costmap.cell(Rover.pos)
+        kind, goal = self._choose_goal(Rover, start)
+        self.goal_kind = kind
+        self.finished = kind == 'home' and math.dist(Rover.pos, self.home) < self.costmap.cell_size * 1.5
+        if goal is None or self.finished:
+            self.goal, self.search, self.waypoints = goal, None, []
+            return
+        if goal != self.goal or self.search is None:
+            self.goal = goal
+            self.search = DStarLite(self.costmap, start, goal)
+        else:
+            self.search.move_start(start)
+            self.search.cells_changed(changed)
+        if self.search.compute(deadline):
+            if self.search.reachable:
+                self.waypoints = [self.costmap.center(cell) for cell in self.search.path()]
+            else:
+                # Give up on this goal for a while, another one is chosen on the next frame
+                self.unreachable[goal] = self.frames + self.retry_frames
+                self.search, self.waypoints = None, []
+
+    # Mark the sample closest to the rover as collected when the count goes up
+    def _track_samples(self, Rover):
+        if Rover.samples_pos is None:
+            return
+        samples_x, samples_y = Rover.samples_pos
+        if self.collected is None:
+            self.collected = np.zeros(len(samples_x), dtype=np.bool_)
+        while self.samples_collected < Rover.samples_collected:
+            self.samples_collected += 1
+            dists = np.hypot(samples_x - Rover.pos[0], samples_y - Rover.pos[1])
+            dists[self.collected] = np.inf
+            if np.isfinite(dists).any():
+                self.collected[np.argmin(dists)] = True
+
+    def _choose_goal(self, Rover, start):
+        registry = Rover.rock_registry
+        if registry is not None and self.collected is not None:
+            pending = np.flatnonzero(registry.located & ~self.collected)
+            cells = [self.costmap.cell((registry.samples_x[idx], registry.samples_y[idx]))
+                     for idx in pending]
+            cells = [cell for cell in cells if cell not in self.unreachable]
+            if cells:
+                return 'sample', min(cells, key=lambda cell: math.dist(cell, start))
+        all_collected = Rover.samples_to_find > 0 and Rover.samples_collected >= Rover.samples_to_find
+        frontiers = self.costmap.frontiers - self.unreachable.keys()
+        explored = not frontiers and (self.costmap.state == FREE).any()
+        if all_collected or Rover.map_view.perc_mapped >= self.mapped_goal or explored:
+            home = self.costmap.cell(self.home)
+            return 'home', None if home in self.unreachable else home
+        if not frontiers:
+            return None, None
+        # Keep going to the current frontier while it is one
+        if self.goal_kind == 'frontier' and self.goal in frontiers:
+            return 'frontier', self.goal
+        return 'frontier', min(frontiers, key=lambda cell: math.dist(cell, start))
+
+    # Next waypoint at least lookahead meters away from pos, None without a route
+    def waypoint(self, pos):
+        for waypoint in self.waypoints:
+            if math.dist(waypoint, pos) >= self.lookahead:
+                return waypoint
+        return self.waypoints[-1] if self.waypoints else None
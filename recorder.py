@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import base64
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# A recording is a folder of segments, each one made of
+#   segment_NNNNN.jpg    the JPEG bytes sent by the simulator, appended back to back
+#   segment_NNNNN.jsonl  one line per frame: time, offset and length of its image
+#                        in the .jpg file and the scalar telemetry fields
+segment_name = 'segment_{:05d}'
+
+# Define a frame recorder writing in the background
+# record() only puts the frame on a bounded queue, a writer thread appends the
+# original JPEG bytes (no re-encoding) and telemetry to segment files in batches.
+# When the queue is full the drop policy decides what happens:
+# 'newest' drops the incoming frame, 'oldest' drops the oldest queued frame
+# and 'block' waits for the writer.
+class FrameRecorder():
+    def __init__(self, folder, max_queue=256, drop_policy='newest', segment_frames=1000):
+        if drop_policy not in ('newest', 'oldest', 'block'):
+            raise ValueError("Unknown drop policy: {}".format(drop_policy))
+        self.folder = folder
+        self.drop_policy = drop_policy
+        self.segment_frames = segment_frames
+        self.recorded = 0
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue)
+        self._segment = -1
+        self._segment_count = 0
+        self._images = None
+        self._index = None
+        os.makedirs(folder, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='frame-recorder', daemon=True)
+        self._thread.start()
+
+    # Queue a decoded telemetry frame for writing
+    def record(self, frame):
+        telemetry = {key: value for key, value in frame.data.items() if key != 'image'}
+        return self._put((time.time(), frame.jpeg, telemetry))
+
+    # Queue telemetry data as received from the simulator, before decoding
+    def record_telemetry(self, data):
+        telemetry = {key: value for key, value in data.items() if key != 'image'}
+        return self._put((time.time(), base64.b64decode(data['image']), telemetry))
+
+    def _put(self, item):
+        if self.drop_policy == 'block':
+            self._queue.put(item)
+            return True
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return True
+            except queue.Full:
+                self.dropped += 1
+                if self.drop_policy == 'newest':
+                    return False
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    # Write the queued frames and close the segment files
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            # Write whatever else is already waiting in the same batch
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                running = False
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception('Failed to write %d frames', len(batch))
+        self._close_segment()
+
+    def _write(self, batch):
+        for timestamp, jpeg, telemetry in batch:
+            if self._images is None or self._segment_count >= self.segment_frames:
+                self._open_segment()
+            offset = self._images.tell()
+            self._images.write(jpeg)
+            self._index.write(json.dumps({'time': timestamp, 'offset': offset,
+                                          'length': len(jpeg), 'telemetry': telemetry}) + '\n')
+            self._segment_count += 1
+            self.recorded += 1
+        if self._images is not None:
+            self._images.flush()
+            self._index.flush()
+
+    def _open_segment(self):
+        self._close_segment()
+        self._segment += 1
+        self._segment_count = 0
+        path = os.path.join(self.folder, segment_name.format(self._segment))
+        self._images = open(path + '.jpg', 'ab')
+        self._index = open(path + '.jsonl', 'a')
+
+    def _close_segment(self):
+        if self._images is not None:
+            self._images.close()
+            self._index.close()
+            self._images = self._index = None
+
+# Define a reader of recordings made by FrameRecorder
+# Iterating yields (time, jpeg bytes, telemetry fields) in recording order
+class RecordingReader():
+    def __init__(self, folder):
+        self.folder = folder
+        self.segments = sorted(name[:-len('.jsonl')] for name in os.listdir(folder)
+                               if name.startswith('segment_') and name.endswith('.jsonl'))
+
+    def __len__(self):
+        count = 0
+        for segment in self.segments:
+            with open(os.path.join(self.folder, segment + '.jsonl')) as index:
+                count += sum(1 for line in index if line.strip())
+        return count
+
+    def __iter__(self):
+        for segment in self.segments:
+            path = os.path.join(self.folder, segment)
+            with open(path + '.jsonl') as index, open(path + '.jpg', 'rb') as images:
+                for line in index:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    images.seek(entry['offset'])
+                    jpeg = images.read(entry['length'])
+                    # Skip a frame cut short by a crash
+                    if len(jpeg) < entry['length']:
+                        return
+                    yield entry['time'], jpeg, entry['telemetry']
+
+    # Yield telemetry data dictionaries as the simulator sent them
+    def telemetry(self):
+        for timestamp, data in self.timed_telemetry():
+            yield data
+
+    # Same as telemetry() with the time each message was recorded
+    def timed_telemetry(self):
+        for timestamp, jpeg, telemetry in self:
+            data = dict(telemetry)
+            data['image'] = base64.b64encode(jpeg).decode('utf-8')
+            yield timestamp, data
@@ -0,0 +1,167 @@
+# Replay recorded runs through the rover pipeline, without the simulator
+#
+# In-process (default), every recorded telemetry message goes through
+# update_rover -> perception_step -> decision_step -> create_output_images
+# exactly as drive_rover.py runs them:
+#   $ python replay.py recording_folder
+# As a stand-in simulator client, the messages are sent to a running
+# drive_rover.py server and the round trip of each reply is measured:
+#   $ python replay.py recording_folder --server http://localhost:4567
+import argparse
+import threading
+import time
+import numpy as np
+
+from perception import perception_step
+from decision import decision_step
+from supporting_functions import update_rover, create_output_images, JpegEncoder
+from recorder import RecordingReader
+from rover_state import RoverState, load_ground_truth
+
+# Define a function to summarize latencies (in seconds) as milliseconds
+def latency_summary(latencies):
+    if len(latencies) == 0:
+        return 'no samples'
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return 'p50 {:.2f} ms  p95 {:.2f} ms  p99 {:.2f} ms  max {:.2f} ms'.format(
+        p50, p95, p99, max(latencies) * 1000)
+
+# Define a function to replay a recording in-process
+# The recorded time of each message drives Rover.total_time, so decisions
+# see the same timing as during the recorded run
+def replay(reader, Rover, render=True, encoders=None, limit=None):
+    stages = ('update_rover', 'perception_step', 'decision_step', 'create_output_images', 'frame')
+    latencies = {stage: [] for stage in stages}
+    invalid = 0
+    recorded_time = [0]
+    Rover.clock = lambda: recorded_time[0]
+    start = time.perf_counter()
+    for count, (timestamp, data) in enumerate(reader.timed_telemetry()):
+        if limit is not None and count >= limit:
+            break
+        recorded_time[0] = timestamp
+        t0 = time.perf_counter()
+        Rover, frame = update_rover(Rover, data)
+        t1 = time.perf_counter()
+        latencies['update_rover'].append(t1 - t0)
+        if not np.isfinite(Rover.vel):
+            invalid += 1
+            continue
+        Rover = perception_step(Rover)
+        t2 = time.perf_counter()
+        Rover = decision_step(Rover)
+        t3 = time.perf_counter()
+        if Rover.send_pickup and not Rover.picking_up:
+            Rover.send_pickup = False
+        latencies['perception_step'].append(t2 - t1)
+        latencies['decision_step'].append(t3 - t2)
+        if render:
+            create_output_images(Rover, encoders)
+            latencies['create_output_images'].append(time.perf_counter() - t3)
+        latencies['frame'].append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    return {
+        'frames': len(latencies['frame']),
+        'invalid': invalid,
+        'elapsed': elapsed,
+        'fps': len(latencies['frame']) / elapsed if elapsed > 0 else 0,
+        'latencies': latencies,
+        'perc_mapped': Rover.map_view.perc_mapped,
+        'fidelity': Rover.map_view.fidelity,
+        'samples_located': Rover.samples_located,
+    }
+
+# Define a function to replay a recording against a drive_rover.py server
+# acting as the simulator: send a telemetry message, wait for its reply
+def replay_to_server(reader, url, limit=None, timeout=5):
+    import socketio
+    client = socketio.Client()
+    replied = threading.Event()
+    client.on('data', lambda data: replied.set())
+    client.on('pickup', lambda data: replied.set())
+    client.connect(url)
+    # Let the connect handshake (and its first control message) go through
+    time.sleep(0.5)
+    latencies = []
+    timeouts = 0
+    start = time.perf_counter()
+    try:
+        for count, data in enumerate(reader.telemetry()):
+            if limit is not None and count >= limit:
+                break
+            replied.clear()
+            t0 = time.perf_counter()
+            client.emit('telemetry', data)
+            if replied.wait(timeout):
+                latencies.append(time.perf_counter() - t0)
+            else:
+                timeouts += 1
+    finally:
+        client.disconnect()
+    elapsed = time.perf_counter() - start
+    return {
+        'frames': len(latencies),
+        'timeouts': timeouts,
+        'elapsed': elapsed,
+        'fps': len(latencies) / elapsed if elapsed > 0 else 0,
+        'latencies': {'round_trip': latencies},
+    }
+
+def print_report(result):
+    print('Frames: {}  ({:.1f} frames/s over {:.1f} s)'.format(
+        result['frames'], result['fps'], result['elapsed']))
+    for key in ('invalid', 'timeouts'):
+        if key in result:
+            print('{}: {}'.format(key.capitalize(), result[key]))
+    for stage, latencies in result['latencies'].items():
+        print('  {:<22}{}'.format(stage, latency_summary(latencies)))
+    if 'perc_mapped' in result:
+        print('Mapped: {}%  Fidelity: {}%  Rocks located: {}'.format(
+            result['perc_mapped'], result['fidelity'], result['samples_located']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded run')
+    parser.add_argument(
+        'recording',
+        type=str,
+        help='Path to a folder recorded by drive_rover.py.'
+    )
+    parser.add_argument(
+        '--server',
+        type=str,
+        default='',
+        help='URL of a drive_rover.py server to replay against instead of replaying in-process.'
+    )
+    parser.add_argument(
+        '--ground-truth',
+        type=str,
+        default=None,
+        help='Ground truth map used for the mapped and fidelity scores.'
+    )
+    parser.add_argument(
+        '--no-render',
+        action='store_true',
+        help='Skip create_output_images.'
+    )
+    parser.add_argument(
+        '--encoder',
+        choices=['pil', 'cv2'],
+        default='pil',
+        help='JPEG encoder of the inset images.'
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=None,
+        help='Replay at most this many frames.'
+    )
+    args = parser.parse_args()
+
+    reader = RecordingReader(args.recording)
+    if args.server:
+        result = replay_to_server(reader, args.server, args.limit)
+    else:
+        Rover = RoverState(load_ground_truth(args.ground_truth))
+        encoders = (JpegEncoder(args.encoder), JpegEncoder(args.encoder))
+        result = replay(reader, Rover, not args.no_render, encoders, args.limit)
+    print_report(result)
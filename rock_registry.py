@@ -0,0 +1,40 @@
+import numpy as np
+
+# Define a registry of the known rock sample positions
+# Samples are bucketed on a grid of `radius` sized cells, so a rock detection
+# only has to be compared with the samples of the 3x3 buckets around it.
+# Detections are matched as they arrive and a sample stays located once a
+# detection was found within `radius` meters of it.
+class RockRegistry():
+    def __init__(self, samples_pos, radius=3):
+        self.samples_x = np.asarray(samples_pos[0])
+        self.samples_y = np.asarray(samples_pos[1])
+        self.radius = radius
+        self.located = np.zeros(len(self.samples_x), dtype=np.bool_)
+        self.buckets = {}
+        for idx, key in enumerate(zip(self.samples_x // radius, self.samples_y // radius)):
+            self.buckets.setdefault((int(key[0]), int(key[1])), []).append(idx)
+
+    @property
+    def samples_located(self):
+        return int(np.count_nonzero(self.located))
+
+    # Match rock detections given in world coordinates to the known samples
+    def observe(self, x_world, y_world):
+        if len(x_world) == 0 or self.located.all():
+            return
+        x_world = np.asarray(x_world)
+        y_world = np.asarray(y_world)
+        bucket_x = x_world // self.radius
+        bucket_y = y_world // self.radius
+        for key in set(zip(bucket_x.tolist(), bucket_y.tolist())):
+            candidates = [idx for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                          for idx in self.buckets.get((key[0] + dx, key[1] + dy), ())
+                          if not self.located[idx]]
+            if not candidates:
+                continue
+            in_bucket = (bucket_x == key[0]) & (bucket_y == key[1])
+            candidates = np.array(candidates)
+            rock_sample_dists = np.sqrt((self.samples_x[candidates, None] - x_world[in_bucket])**2 +
+                                        (self.samples_y[candidates, None] - y_world[in_bucket])**2)
+            self.located[candidates[rock_sample_dists.min(axis=1) < self.radius]] = True
@@ -0,0 +1,151 @@
+import os
+import time
+import hashlib
+import tempfile
+import numpy as np
+import cv2
+
+from occupancy import OccupancyGrid
+from map_view import MapView
+from flight_recorder import FlightRecorder
+
+# Ground truth map shipped with the project, found from this file so it
+# does not depend on the working directory
+default_map_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'calibration_images', 'map_bw.png')
+
+# Ground truth maps already loaded by this process, by path
+_ground_truths = {}
+
+# Define a function to read in ground truth map and create 3-channel green version for overplotting
+def read_ground_truth(path):
+    # NOTE: images are read in with the origin (0, 0) in the upper left
+    # and y-axis increasing downward.
+    ground_truth = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if ground_truth is None:
+        raise IOError("Cannot read the ground truth map {}".format(path))
+    # This next line creates arrays of zeros in the red and blue channels
+    # and puts the map into the green channel.  This is why the underlying 
+    # map output looks green in the display image
+    zeros = np.zeros_like(ground_truth)
+    return np.dstack((zeros, ground_truth, zeros))
+
+# Define a function to get the path of the preprocessed ground truth cache,
+# next to the map or in the temporary folder when that one is read only
+def ground_truth_cache_path(path):
+    folder, name = os.path.split(path)
+    if not os.access(folder, os.W_OK):
+        digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:12]
+        folder, name = tempfile.gettempdir(), '{}-{}'.format(digest, name)
+    return os.path.join(folder, os.path.splitext(name)[0] + '.ground_truth.npy')
+
+# Define a function to load the ground truth map (path defaults to the
+# ROVER_MAP environment variable, then to the map shipped with the project)
+# The preprocessed map is cached as a uint8 .npy file, rebuilt when the map
+# is newer, and memory-mapped read only so processes share its pages.
+def load_ground_truth(path=None, cache=True):
+    path = os.path.abspath(path or os.environ.get('ROVER_MAP') or default_map_path)
+    if path in _ground_truths:
+        return _ground_truths[path]
+    if not cache:
+        ground_truth = read_ground_truth(path)
+    else:
+        cache_path = ground_truth_cache_path(path)
+        try:
+            if (not os.path.exists(cache_path)
+                    or os.path.getmtime(cache_path) < os.path.getmtime(path)):
+                # Written to a temporary file first, so that concurrent
+                # workers never load a partial cache. Readable by everyone
+                # (as the umask allows), other users' processes share it too
+                tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+                fd = os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, read_ground_truth(path))
+                os.replace(tmp_path, cache_path)
+            ground_truth = np.load(cache_path, mmap_mode='r')
+        except OSError:
+            # Cache written by someone else and not readable, or not writable
+            ground_truth = read_ground_truth(path)
+    _ground_truths[path] = ground_truth
+    return ground_truth
+
+# Define RoverState() class to retain rover state parameters
+class RoverState():
+    def __init__(self, ground_truth):
+        self.start_time = None # To record the start time of navigation
+        self.total_time = None # To record total duration of naviagation
+        self.clock = time.time # Source of the navigation time (recorded time when replaying)
+        self.stuck_time = 0 # To record moment that got stuck
+        self.rock_time = 0 # To record moment that started to go for the near rock sample
+        self.img = None # Current camera image
+        self.pos = None # Current position (x, y)
+        self.yaw = None # Current yaw angle
+        self.pitch = None # Current pitch angle
+        self.roll = None # Current roll angle
+        self.vel = None # Current velocity
+        self.steer = 0 # Current steering angle
+        self.throttle = 0 # Current throttle value
+        self.brake = 0 # Current brake value
+        self.nav_angles = None  # Angles of navigable terrain pixels
+        self.nav_dists = None # Distances of navigable terrain pixels
+        self.nav_summary = None # Polar histogram of navigable terrain (perception.PolarHistogram)
+        self.rock_detections = [] # Rock samples in view (perception.RockDetection)
+        self.samples_angles = None  # Angles of the rock samples in view
+        self.samples_dists = None  # Distances of the rock samples in view
+        self.ground_truth = ground_truth # Ground truth worldmap
+        self.mode = ['forward'] # Current mode (can be forward or stop)
+        self.throttle_set = 0.5 # Throttle setting when accelerating
+        self.brake_set = 10 # Brake setting when braking
+        # The stop_forward and go_forward fields below represent total count
+        # of navigable terrain pixels.  This is a very crude form of knowing
+        # when you can keep going and when you should stop.  Feel free to
+        # get creative in adding new fields or modifying these!
+        self.stop_forward = 100 # Threshold to initiate stopping
+        self.go_forward = 500 # Threshold to go forward again
+        self.max_vel = 3 # Maximum velocity (meters/second)
+        # Also count as stuck when the flight recorder shows the rover
+        # throttling without getting anywhere (see FlightRecorder.stalled)
+        self.stall_check = False
+        # Perspective transform calibration, the destination box is
+        # 2*dst_size pixels on each side and bottom_offset pixels above
+        # the bottom of the warped image
+        self.dst_size = 5
+        self.bottom_offset = 6
+        # Color thresholds, navigable terrain is above nav_thresh in RGB
+        # and rock samples are within rock_lower/rock_upper in HSV
+        self.nav_thresh = (160, 160, 160)
+        self.rock_lower = (24 - 5, 100, 100)
+        self.rock_upper = (24 + 5, 255, 255)
+        # Navigable terrain and obstacles farther than view_range pixels
+        # of the warped image are not mapped
+        self.view_range = 80
+        # Image output from perception step
+        # Update this image to display your intermediate analysis steps
+        # on screen in autonomous mode
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.uint8)
+        # Worldmap
+        # Update this image with the positions of navigable terrain
+        # obstacles and rock samples
+        self.worldmap = np.zeros((200, 200, 3), dtype=np.uint8)
+        # Per-cell hit counts behind the worldmap
+        self.occupancy = OccupancyGrid(self.worldmap)
+        # Incrementally rendered map display and mapping statistics
+        self.map_view = MapView(self.ground_truth, self.occupancy)
+        # Perception buffers, preallocated and written in place every frame
+        self.camera_labels = np.zeros((160, 320), dtype=np.uint8) # Class labels of the camera image
+        self.warped_labels = np.zeros((160, 320), dtype=np.uint8) # Class labels of the warped image
+        self.navigable_mask = np.zeros((160, 320), dtype=np.bool_)
+        self.obstacles_mask = np.zeros((160, 320), dtype=np.uint8) # Viewed as bool
+        self.rocks_mask = np.zeros((160, 320), dtype=np.bool_)
+        self.samples_pos = None # To store the actual sample positions
+        self.rock_registry = None # Known sample positions and whether they were located
+        self.samples_to_find = 0 # To store the initial count of samples
+        self.samples_located = 0 # To store number of samples located on map
+        self.samples_collected = 0 # To count the number of samples collected
+        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
+        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
+        self.send_pickup = False # Set to True to trigger rock pickup
+        self.history = FlightRecorder() # Ring buffer of the recent per-frame state
+        self.planner = None # Global planner followed by decision_step (planner.Planner)
+        self.governor = None # Frame budget governor setting the perception quality (governor.FrameGovernor)
+        self.checkpoint = None # Background checkpoints of the map and mission state (checkpoint.Checkpointer)
@@ -0,0 +1,146 @@
+import zlib
+import time
+import logging
+import threading
+import multiprocessing
+import numpy as np
+
+from perception import perception_step
+from decision import decision_step
+from supporting_functions import update_rover, encode_output_images, JpegEncoder
+from telemetry import TelemetryDecoder
+from rover_state import RoverState, load_ground_truth
+from planner import Planner
+from governor import FrameGovernor
+
+logger = logging.getLogger(__name__)
+
+# Define a session: the rover of one connected simulator
+# Each session has its own RoverState, telemetry decoder and image encoders,
+# and its own global planner (plan_budget > 0) and frame budget governor
+# (frame_budget > 0), budgets in seconds as in drive_rover.py
+class Session():
+    def __init__(self, sid, ground_truth, encoder='pil', plan_budget=0, frame_budget=0):
+        self.sid = sid
+        self.Rover = RoverState(ground_truth)
+        self.decoder = TelemetryDecoder()
+        self.encoders = (JpegEncoder(encoder), JpegEncoder(encoder))
+        if plan_budget > 0:
+            self.Rover.planner = Planner(self.Rover.occupancy, budget=plan_budget)
+        if frame_budget > 0:
+            self.Rover.governor = FrameGovernor(frame_budget)
+
+    # Run one telemetry message through the rover, returns the reply to send:
+    # ('pickup', None) or ('data', (commands, jpeg1, jpeg2))
+    def process(self, data):
+        Rover, frame = update_rover(self.Rover, data, self.decoder)
+        # In case of invalid telemetry, send null commands
+        if not np.isfinite(Rover.vel):
+            return 'data', ((0, 0, 0), b'', b'')
+        start = time.perf_counter()
+        Rover = perception_step(Rover)
+        if Rover.governor is not None:
+            Rover.governor.observe(time.perf_counter() - start)
+        Rover = decision_step(Rover)
+        # If in a state where want to pickup a rock send pickup command
+        if Rover.send_pickup and not Rover.picking_up:
+            Rover.send_pickup = False
+            return 'pickup', None
+        out_image1, out_image2 = encode_output_images(Rover, self.encoders)
+        commands = (float(Rover.throttle), float(Rover.brake), float(Rover.steer))
+        return 'data', (commands, out_image1, out_image2)
+
+# Define a session manager keeping one Session per socketio client (sid)
+class SessionManager():
+    def __init__(self, ground_truth, encoder='pil', plan_budget=0, frame_budget=0):
+        self.ground_truth = ground_truth
+        self.encoder = encoder
+        self.plan_budget = plan_budget
+        self.frame_budget = frame_budget
+        self.sessions = {}
+
+    def process(self, sid, data):
+        session = self.sessions.get(sid)
+        if session is None:
+            logger.info('New session %s', sid)
+            session = self.sessions[sid] = Session(sid, self.ground_truth, self.encoder,
+                                                   self.plan_budget, self.frame_budget)
+        return session.process(data)
+
+    def disconnect(self, sid):
+        self.sessions.pop(sid, None)
+
+    def close(self):
+        self.sessions.clear()
+
+# Define a function to serve the sessions of one shard in a worker process
+# The ground truth map is loaded from the shared cache, not sent over
+def _serve_shard(conn, map_path, encoder, plan_budget, frame_budget):
+    manager = SessionManager(load_ground_truth(map_path), encoder, plan_budget, frame_budget)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            # The server process is gone
+            break
+        if message is None:
+            break
+        command, sid, data = message
+        if command == 'telemetry':
+            try:
+                reply = manager.process(sid, data)
+            except Exception:
+                logger.exception('Session %s failed', sid)
+                reply = ('data', ((0, 0, 0), b'', b''))
+            conn.send(reply)
+        elif command == 'disconnect':
+            manager.disconnect(sid)
+    conn.close()
+
+# Define a session manager sharding sessions across worker processes
+# A session always goes to the same worker (by a hash of its sid), so its
+# RoverState lives in that process and perception for N rovers runs on up to
+# `workers` cores. Calls go through eventlet's thread pool when available so
+# the socketio loop keeps serving other clients while a worker is busy.
+class ShardedSessionManager():
+    def __init__(self, map_path, workers, encoder='pil', plan_budget=0, frame_budget=0):
+        context = multiprocessing.get_context('spawn')
+        self._conns = []
+        self._locks = []
+        self._processes = []
+        for shard in range(workers):
+            conn, worker_conn = context.Pipe()
+            process = context.Process(target=_serve_shard,
+                                      args=(worker_conn, map_path, encoder, plan_budget, frame_budget),
+                                      name='rover-shard-{}'.format(shard), daemon=True)
+            process.start()
+            self._conns.append(conn)
+            self._locks.append(threading.Lock())
+            self._processes.append(process)
+        try:
+            from eventlet import tpool
+            self._execute = tpool.execute
+        except ImportError:
+            self._execute = lambda function, *args: function(*args)
+
+    def _shard(self, sid):
+        return zlib.crc32(sid.encode('utf-8')) % len(self._conns)
+
+    def _call(self, shard, message, reply=True):
+        with self._locks[shard]:
+            self._conns[shard].send(message)
+            if reply:
+                return self._conns[shard].recv()
+
+    def process(self, sid, data):
+        return self._execute(self._call, self._shard(sid), ('telemetry', sid, data))
+
+    def disconnect(self, sid):
+        shard = self._shard(sid)
+        self._execute(self._call, shard, ('disconnect', sid, None), False)
+
+    def close(self):
+        for shard in range(len(self._conns)):
+            self._call(shard, None, False)
+        for process in self._processes:
+            process.join()
@@ -0,0 +1,300 @@
+# Headless stand-in for the Unity simulator
+#
+# The world is the ground truth map drive_rover.py loads (map_bw.png) with
+# rock samples scattered on navigable terrain. A fleet of independent rovers
+# is stepped together with numpy: a kinematic model driven by throttle, brake
+# and steer, and a synthetic camera that renders the ground seen by every
+# rover through the inverse of the perception perspective transform. Each
+# rover runs the real update_rover/perception_step/decision_step code on
+# those frames, and episodes can be spread across a process pool:
+#   $ python simulator.py --episodes 100 --rovers 8 --duration 300 --workers 4
+import argparse
+import os
+import time
+import numpy as np
+import cv2
+from concurrent.futures import ProcessPoolExecutor
+
+from perception import perception_step, calibration_points, calib_source
+from decision import decision_step
+from supporting_functions import apply_telemetry
+from rover_state import RoverState, load_ground_truth
+
+# Scene labels and their colors in the camera images
+SCENE_OBSTACLE = 0
+SCENE_NAVIGABLE = 1
+SCENE_ROCK = 2
+scene_colors = np.array([[110, 85, 70],    # Rock walls and far terrain
+                         [205, 185, 170],  # Sand, above the navigable threshold
+                         [200, 170, 20]],  # Yellow rock samples
+                        dtype=np.uint8)
+sky_color = np.array([120, 140, 165], dtype=np.uint8)
+
+# Define the simulated world
+# The scene is the ground truth map upsampled `resolution` times (so rocks of
+# `rock_radius` meters can be drawn) with the rock samples on it
+class SimWorld():
+    def __init__(self, ground_truth, samples=6, seed=None, resolution=10, rock_radius=0.3):
+        self.rng = np.random.default_rng(seed)
+        self.navigable = ground_truth[:,:,1] > 0
+        self.resolution = resolution
+        # Samples on navigable cells surrounded by navigable terrain
+        open_cells = np.argwhere(cv2.erode(self.navigable.astype(np.uint8), np.ones((3, 3))) > 0)
+        picks = open_cells[self.rng.choice(len(open_cells), samples, replace=False)]
+        self.samples_pos = (picks[:, 1].astype(np.float64) + 0.5, picks[:, 0].astype(np.float64) + 0.5)
+        scene = np.repeat(np.repeat(self.navigable.astype(np.uint8), resolution, axis=0),
+                          resolution, axis=1)
+        for x, y in zip(*self.samples_pos):
+            cv2.circle(scene, (int(x * resolution), int(y * resolution)),
+                       int(rock_radius * resolution), SCENE_ROCK, -1)
+        self.scene = scene
+        self.scene_colors = scene_colors[scene]
+
+    # Random start positions on open navigable terrain
+    def random_starts(self, count):
+        open_cells = np.argwhere(cv2.erode(self.navigable.astype(np.uint8), np.ones((5, 5))) > 0)
+        picks = open_cells[self.rng.choice(len(open_cells), count)]
+        yaw = self.rng.uniform(0, 360, count)
+        return picks[:, 1] + 0.5, picks[:, 0] + 0.5, yaw
+
+# Define the synthetic camera
+# perception_step maps a camera pixel to the warped image with the
+# calibration transform, then to rover coordinates (10 pixels per meter).
+# The camera does the same once per pixel, so a frame only has to rotate and
+# translate those ground points by the rover pose and look them up in the
+# scene. Pixels above the horizon are sky.
+class SimCamera():
+    def __init__(self, shape=(160, 320), dst_size=5, bottom_offset=6, scale=10.0, max_range=60):
+        self.shape = tuple(shape[:2])
+        rows, cols = self.shape
+        source, destination = calibration_points(self.shape, dst_size, bottom_offset, calib_source)
+        M = cv2.getPerspectiveTransform(source, destination)
+        # Scale the transform so that w is positive on the ground
+        if (M @ [cols / 2, rows - 1, 1])[2] < 0:
+            M = -M
+        ys, xs = np.indices(self.shape)
+        points = M @ np.stack((xs.ravel(), ys.ravel(), np.ones(xs.size)))
+        w = points[2]
+        ground = w > 1e-9
+        warped_x = points[0][ground] / w[ground]
+        warped_y = points[1][ground] / w[ground]
+        # Rover coordinates in meters, x ahead and y to the left
+        forward = (rows - warped_y) / scale
+        left = (cols / 2 - warped_x) / scale
+        ground_idx = np.flatnonzero(ground)
+        in_range = (forward > 0) & (np.hypot(forward, left) < max_range)
+        self.ground = ground_idx[in_range]
+        self.forward = forward[in_range].astype(np.float32)
+        self.left = left[in_range].astype(np.float32)
+        # Colors of the pixels that are not looked up: sky or far terrain
+        self.background = np.where(ground[:, None], scene_colors[SCENE_OBSTACLE], sky_color)
+
+    # Render the camera frames of rovers at (x, y, yaw), into out if given
+    # (an (n, rows, cols, 3) uint8 array)
+    def render(self, world, x, y, yaw, out=None):
+        n = len(x)
+        if out is None:
+            out = np.empty((n,) + self.shape + (3,), dtype=np.uint8)
+        flat = out.reshape(n, -1, 3)
+        flat[:] = self.background
+        yaw_rad = np.radians(yaw).astype(np.float32)[:, None]
+        cos, sin = np.cos(yaw_rad), np.sin(yaw_rad)
+        world_x = (self.forward * cos - self.left * sin) + np.float32(x)[:, None]
+        world_y = (self.forward * sin + self.left * cos) + np.float32(y)[:, None]
+        # Look the ground points up in the scene colors with one remap for
+        # all the rovers, the (n, points) coordinates are used as the map
+        resolution = np.float32(world.resolution)
+        colors = cv2.remap(world.scene_colors, world_x * resolution, world_y * resolution,
+                           cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT,
+                           borderValue=scene_colors[SCENE_OBSTACLE].tolist())
+        flat[:, self.ground] = colors
+        return out
+
+# Define a telemetry frame of a simulated rover
+# Same attributes as telemetry.TelemetryFrame, so apply_telemetry takes it
+class SimFrame():
+    def __init__(self, fleet, idx):
+        self.data = {}
+        self.jpeg = None
+        self.image = fleet.images[idx]
+        self.vel = float(fleet.vel[idx])
+        self.pos = [float(fleet.x[idx]), float(fleet.y[idx])]
+        self.yaw = float(fleet.yaw[idx])
+        self.pitch = 0.0
+        self.roll = 0.0
+        self.throttle = float(fleet.throttle[idx])
+        self.steer = float(fleet.steer[idx])
+        self.near_sample = int(fleet.near_sample[idx])
+        self.picking_up = int(fleet.pickup_time[idx] > 0)
+        self.sample_count = int(np.count_nonzero(~fleet.collected[idx]))
+        self._samples_pos = fleet.world.samples_pos
+
+    def samples_pos(self):
+        return np.int_(self._samples_pos[0]), np.int_(self._samples_pos[1])
+
+# Define a fleet of independent rovers in the same world
+# The kinematic model is a bicycle model with first order throttle, brake and
+# drag, plus turning in place when stopped with the brake released (as the
+# Unity rover does with four wheel steering). Moves into non navigable cells
+# are blocked and stop the rover.
+class RoverFleet():
+    def __init__(self, world, count, camera=None, accel=4.0, brake_decel=1.0, drag=0.4,
+                 max_vel=5.0, wheelbase=2.5, turn_rate=3.0, near_distance=1.5, pickup_duration=3.0):
+        self.world = world
+        self.camera = camera if camera is not None else SimCamera()
+        self.accel = accel
+        self.brake_decel = brake_decel
+        self.drag = drag
+        self.max_vel = max_vel
+        self.wheelbase = wheelbase
+        self.turn_rate = turn_rate
+        self.near_distance = near_distance
+        self.pickup_duration = pickup_duration
+        self.time = 0.0
+        self.x, self.y, self.yaw = world.random_starts(count)
+        self.x, self.y = self.x.astype(np.float64), self.y.astype(np.float64)
+        self.vel = np.zeros(count)
+        self.throttle = np.zeros(count)
+        self.brake = np.zeros(count)
+        self.steer = np.zeros(count)
+        self.pickup_time = np.zeros(count)
+        self.collected = np.zeros((count, len(world.samples_pos[0])), dtype=np.bool_)
+        self.near_sample = np.zeros(count, dtype=np.bool_)
+        self.distance = np.zeros(count)
+        self.images = self.camera.render(world, self.x, self.y, self.yaw)
+        self._update_samples()
+
+    def __len__(self):
+        return len(self.x)
+
+    def _update_samples(self):
+        samples_x, samples_y = self.world.samples_pos
+        dists = np.hypot(samples_x - self.x[:, None], samples_y - self.y[:, None])
+        dists[self.collected] = np.inf
+        self.near_sample = dists.min(axis=1) < self.near_distance
+
+    # Start picking up the closest sample of rover idx, when near one and stopped
+    def pickup(self, idx):
+        if not self.near_sample[idx] or abs(self.vel[idx]) > 0.2 or self.pickup_time[idx] > 0:
+            return
+        samples_x, samples_y = self.world.samples_pos
+        dists = np.hypot(samples_x - self.x[idx], samples_y - self.y[idx])
+        dists[self.collected[idx]] = np.inf
+        self.collected[idx, np.argmin(dists)] = True
+        self.pickup_time[idx] = self.pickup_duration
+
+    # Apply the commands of every rover for dt seconds and render the new frames
+    def step(self, throttle, brake, steer, dt=0.1):
+        self.throttle[:] = throttle
+        self.brake[:] = brake
+        self.steer[:] = steer
+        picking = self.pickup_time > 0
+        self.pickup_time = np.maximum(self.pickup_time - dt, 0)
+        # Rovers picking up a sample do not move
+        throttle = np.where(picking, 0, self.throttle)
+        braking = np.where(picking, 10, self.brake)
+        accel = throttle * self.accel - self.drag * self.vel
+        vel = self.vel + accel * dt
+        # Brakes slow down to a standstill, not backwards
+        slowdown = np.minimum(braking * self.brake_decel * dt, np.abs(vel))
+        vel = np.clip(vel - np.sign(vel) * slowdown, -self.max_vel, self.max_vel)
+        steer_rad = np.radians(self.steer)
+        yaw_rate = np.degrees(vel * np.tan(steer_rad) / self.wheelbase)
+        # Turn in place when stopped with the brake released
+        in_place = (np.abs(vel) < 0.2) & (throttle == 0) & (braking == 0)
+        yaw_rate = np.where(in_place, self.steer * self.turn_rate, yaw_rate)
+        yaw = (self.yaw + yaw_rate * dt) % 360
+        x = self.x + vel * np.cos(np.radians(yaw)) * dt
+        y = self.y + vel * np.sin(np.radians(yaw)) * dt
+        # Moves into walls are blocked
+        rows, cols = self.world.navigable.shape
+        cell_x = np.clip(x.astype(np.intp), 0, cols - 1)
+        cell_y = np.clip(y.astype(np.intp), 0, rows - 1)
+        free = self.world.navigable[cell_y, cell_x]
+        self.distance += np.where(free, np.hypot(x - self.x, y - self.y), 0)
+        self.x = np.where(free, x, self.x)
+        self.y = np.where(free, y, self.y)
+        self.vel = np.where(free, vel, 0)
+        self.yaw = yaw
+        self.time += dt
+        self._update_samples()
+        self.camera.render(self.world, self.x, self.y, self.yaw, out=self.images)
+
+    def frame(self, idx):
+        return SimFrame(self, idx)
+
+# Define a function to run one episode of a fleet of rovers
+# Returns a result dictionary per rover. configure(Rover) may change the
+# RoverState settings (e.g. thresholds) before the episode starts.
+def run_episode(seed, rovers=8, duration=300, dt=0.1, samples=6, configure=None,
+                ground_truth_path=None):
+    ground_truth = load_ground_truth(ground_truth_path)
+    world = SimWorld(ground_truth, samples, seed)
+    fleet = RoverFleet(world, rovers)
+    states = []
+    for idx in range(rovers):
+        Rover = RoverState(ground_truth)
+        Rover.clock = lambda: fleet.time
+        if configure is not None:
+            configure(Rover)
+        states.append(Rover)
+    commands = np.zeros((3, rovers))
+    compute_time = 0.0
+    for step in range(int(duration / dt)):
+        start = time.perf_counter()
+        for idx, Rover in enumerate(states):
+            apply_telemetry(Rover, fleet.frame(idx))
+            Rover = perception_step(Rover)
+            Rover = decision_step(Rover)
+            if Rover.send_pickup and not Rover.picking_up:
+                Rover.send_pickup = False
+                fleet.pickup(idx)
+            commands[:, idx] = Rover.throttle, Rover.brake, Rover.steer
+        compute_time += time.perf_counter() - start
+        fleet.step(commands[0], commands[1], np.clip(commands[2], -15, 15), dt)
+    results = []
+    for idx, Rover in enumerate(states):
+        results.append({
+            'seed': seed,
+            'rover': idx,
+            'perc_mapped': Rover.map_view.perc_mapped,
+            'fidelity': Rover.map_view.fidelity,
+            'samples_located': Rover.samples_located,
+            'samples_collected': int(np.count_nonzero(fleet.collected[idx])),
+            'distance': float(fleet.distance[idx]),
+            'compute_time': compute_time / rovers,
+        })
+    return results
+
+# Define a function to run episodes across a process pool
+def run_episodes(seeds, workers=0, **kwargs):
+    if workers <= 0:
+        return [result for seed in seeds for result in run_episode(seed, **kwargs)]
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(run_episode, seed, **kwargs) for seed in seeds]
+        return [result for future in futures for result in future.result()]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run simulated episodes')
+    parser.add_argument('--episodes', type=int, default=4, help='Number of episodes (worlds).')
+    parser.add_argument('--rovers', type=int, default=8, help='Rovers stepped together per episode.')
+    parser.add_argument('--duration', type=float, default=300, help='Simulated seconds per episode.')
+    parser.add_argument('--dt', type=float, default=0.1, help='Simulation time step in seconds.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the first episode.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes (0 runs in this process).')
+    parser.add_argument('--ground-truth', type=str, default=None,
+                        help='Ground truth map of the world.')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = run_episodes(range(args.seed, args.seed + args.episodes), args.workers,
+                           rovers=args.rovers, duration=args.duration, dt=args.dt,
+                           ground_truth_path=args.ground_truth)
+    elapsed = time.perf_counter() - start
+    for key in ('perc_mapped', 'fidelity', 'samples_located', 'samples_collected', 'distance'):
+        values = np.array([result[key] for result in results])
+        print('{:18s} mean {:8.2f}  min {:8.2f}  max {:8.2f}'.format(
+              key, values.mean(), values.min(), values.max()))
+    print('{} rover episodes of {:.0f} s simulated in {:.1f} s'.format(
+          len(results), args.duration, elapsed))
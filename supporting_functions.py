@@ -1,146 +1,158 @@
 import numpy as np
 import cv2
-from PIL import Image
-from io import BytesIO, StringIO
+from io import BytesIO
 import base64
-import time
+import logging
 
-# Define a function to convert telemetry strings to float independent of decimal convention
-def convert_to_float(string_to_convert):
-      if ',' in string_to_convert:
-            float_value = np.float(string_to_convert.replace(',','.'))
-      else: 
-            float_value = np.float(string_to_convert)
-      return float_value
+from rock_registry import RockRegistry
+from telemetry import TelemetryDecoder
 
-def update_rover(Rover, data):
+logger = logging.getLogger(__name__)
+
+# Decoder used by update_rover when none is given
+_decoder = None
+
+# Define a function to update the Rover with the telemetry data
+# The decoded frame is returned for optional saving, it holds the scalar fields,
+# the original JPEG bytes and the RGB image (in a buffer reused between frames)
+def update_rover(Rover, data, decoder=None):
+      global _decoder
+      if decoder is None:
+            if _decoder is None:
+                  _decoder = TelemetryDecoder()
+            decoder = _decoder
+      frame = decoder.decode(data)
+      apply_telemetry(Rover, frame)
+      # Return updated Rover and separate frame for optional saving
+      return Rover, frame
+
+# Define a function to update the Rover with a decoded telemetry frame
+def apply_telemetry(Rover, frame):
       # Initialize start time and sample positions
       if Rover.start_time == None:
-            Rover.start_time = time.time()
+            Rover.start_time = Rover.clock()
             Rover.total_time = 0
-            samples_xpos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_x"].split(';')])
-            samples_ypos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_y"].split(';')])
-            Rover.samples_pos = (samples_xpos, samples_ypos)
-            Rover.samples_to_find = np.int(data["sample_count"])
+            Rover.samples_pos = frame.samples_pos()
+            # Spatial index of the known samples to match rock detections against
+            Rover.rock_registry = RockRegistry(Rover.samples_pos)
+            Rover.samples_to_find = frame.sample_count
       # Or just update elapsed time
       else:
-            tot_time = time.time() - Rover.start_time
+            tot_time = Rover.clock() - Rover.start_time
             if np.isfinite(tot_time):
                   Rover.total_time = tot_time
       # Print out the fields in the telemetry data dictionary
-      print(data.keys())
+      logger.debug('telemetry fields: %s', list(frame.data.keys()))
       # The current speed of the rover in m/s
-      Rover.vel = convert_to_float(data["speed"])
+      Rover.vel = frame.vel
       # The current position of the rover
-      Rover.pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
+      Rover.pos = frame.pos
       # The current yaw angle of the rover
-      Rover.yaw = convert_to_float(data["yaw"])
+      Rover.yaw = frame.yaw
       # The current yaw angle of the rover
-      Rover.pitch = convert_to_float(data["pitch"])
+      Rover.pitch = frame.pitch
       # The current yaw angle of the rover
-      Rover.roll = convert_to_float(data["roll"])
+      Rover.roll = frame.roll
       # The current throttle setting
-      Rover.throttle = convert_to_float(data["throttle"])
+      Rover.throttle = frame.throttle
       # The current steering angle
-      Rover.steer = convert_to_float(data["steering_angle"])
+      Rover.steer = frame.steer
       # Near sample flag
-      Rover.near_sample = np.int(data["near_sample"])
+      Rover.near_sample = frame.near_sample
       # Picking up flag
-      Rover.picking_up = np.int(data["picking_up"])
+      Rover.picking_up = frame.picking_up
       # Update number of rocks collected
-      Rover.samples_collected = Rover.samples_to_find - np.int(data["sample_count"])
+      Rover.samples_collected = Rover.samples_to_find - frame.sample_count
 
-      print('speed =',Rover.vel, 'position =', Rover.pos, 'throttle =', 
-      Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample, 
-      'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup, 
-      'total time:', Rover.total_time, 'samples remaining:', data["sample_count"], 
-      'samples collected:', Rover.samples_collected)
+      if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('speed = %s position = %s throttle = %s steer_angle = %s '
+                         'near_sample: %s picking_up: %s sending pickup: %s total time: %s '
+                         'samples remaining: %s samples collected: %s',
+                         Rover.vel, Rover.pos, Rover.throttle, Rover.steer, Rover.near_sample,
+                         Rover.picking_up, Rover.send_pickup, Rover.total_time,
+                         frame.sample_count, Rover.samples_collected)
       # Get the current image from the center camera of the rover
-      imgString = data["image"]
-      image = Image.open(BytesIO(base64.b64decode(imgString)))
-      Rover.img = np.asarray(image)
+      Rover.img = frame.image
 
-      # Return updated Rover and separate image for optional saving
-      return Rover, image
+# Define a JPEG encoder for the output images that reuses its buffers between frames
+# encoder='cv2' goes through cv2.imencode, which is faster than PIL
+class JpegEncoder():
+    def __init__(self, encoder='pil', quality=75):
+        self.encoder = encoder
+        self.quality = quality
+        self._buff = BytesIO()
+        self._bgr = None
+
+    # Encode an RGB uint8 image, returns the JPEG bytes
+    def encode(self, img):
+        if self.encoder == 'cv2':
+            if self._bgr is None or self._bgr.shape != img.shape:
+                self._bgr = np.empty_like(img)
+            cv2.cvtColor(img, cv2.COLOR_RGB2BGR, dst=self._bgr)
+            ok, jpeg = cv2.imencode('.jpg', self._bgr, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            return jpeg.tobytes()
+        self._buff.seek(0)
+        self._buff.truncate()
+        # PIL is only imported when it is used
+        from PIL import Image
+        Image.fromarray(img).save(self._buff, format="JPEG", quality=self.quality)
+        return self._buff.getvalue()
 
 # Define a function to create display output given worldmap results
-def create_output_images(Rover):
-
-    # Create a scaled map for plotting and clean up obs/nav pixels a bit
-    if np.max(Rover.worldmap[:,:,2]) > 0:
-        nav_pix = Rover.worldmap[:,:,2] > 0
-        navigable = Rover.worldmap[:,:,2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
-    else:
-        navigable = Rover.worldmap[:,:,2]
-    if np.max(Rover.worldmap[:,:,0]) > 0:
-        obs_pix = Rover.worldmap[:,:,0] > 0
-        obstacle = Rover.worldmap[:,:,0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
-    else:
-        obstacle = Rover.worldmap[:,:,0]
-
-    likely_nav = navigable >= obstacle
-    obstacle[likely_nav] = 0
-    plotmap = np.zeros_like(Rover.worldmap)
-    plotmap[:, :, 0] = obstacle
-    plotmap[:, :, 2] = navigable
-    plotmap = plotmap.clip(0, 255).astype(np.uint8)  # Ensure plotmap is in uint8
-
-    # Convert ground_truth to uint8 for compatibility with plotmap
-    ground_truth = Rover.ground_truth.astype(np.uint8)
-
-    # Overlay obstacle and navigable terrain map with ground truth map
-    map_add = cv2.addWeighted(plotmap, 1, ground_truth, 0.5, 0)
-
-    # Check whether any rock detections are present in worldmap
-    rock_world_pos = Rover.worldmap[:,:,1].nonzero()
-    # If there are, we'll step through the known sample positions
-    # to confirm whether detections are real
+# Returns the JPEG bytes of the map and vision images, encoded
+# with a pair of JpegEncoder (new PIL encoders by default)
+def encode_output_images(Rover, encoders=None):
+    if encoders is None:
+        encoders = (JpegEncoder(), JpegEncoder())
+    map_add, vision_image = render_output_images(Rover)
+    return encoders[0].encode(map_add), encoders[1].encode(vision_image)
+
+# Same as encode_output_images, as base64 strings for sending to server
+def create_output_images(Rover, encoders=None):
+    jpeg1, jpeg2 = encode_output_images(Rover, encoders)
+    encoded_string1 = base64.b64encode(jpeg1).decode("utf-8")
+    encoded_string2 = base64.b64encode(jpeg2).decode("utf-8")
+
+    return encoded_string1, encoded_string2
+
+# Define a function to draw the display images, returns the map and vision images
+# The map tiles in dirty_tiles are redrawn when given, otherwise the map view
+# is brought up to date and the tiles it marked dirty are redrawn
+def render_output_images(Rover, dirty_tiles=None):
+
+    # Overlay the obstacle and navigable terrain map with ground truth map
+    map_view = Rover.map_view
+    if dirty_tiles is None:
+        map_view.update(Rover.worldmap)
+    map_add = map_view.render(Rover.worldmap, dirty_tiles).copy()
+
+    # Samples that had rocks detected within 3 meters of their known
+    # position are flagged as located by the rock registry,
+    # plot the location of those known samples on the map
     samples_located = 0
-    if rock_world_pos[0].any():
+    if Rover.rock_registry is not None:
+        samples_located = Rover.rock_registry.samples_located
         rock_size = 2
-        for idx in range(len(Rover.samples_pos[0])):
+        for idx in np.flatnonzero(Rover.rock_registry.located):
             test_rock_x = Rover.samples_pos[0][idx]
             test_rock_y = Rover.samples_pos[1][idx]
-            rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 + \
-                                        (test_rock_y - rock_world_pos[0])**2)
-            # If rocks were detected within 3 meters of known sample positions
-            # consider it a success and plot the location of the known
-            # sample on the map
-            if np.min(rock_sample_dists) < 3:
-                samples_located += 1
-                map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
-
-    # Calculate some statistics on the map results
-    # First get the total number of pixels in the navigable terrain map
-    tot_nav_pix = np.float(len((plotmap[:,:,2].nonzero()[0])))
-    # Next figure out how many of those correspond to ground truth pixels
-    good_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] > 0)).nonzero()[0]))
-    # Next find how many do not correspond to ground truth pixels
-    bad_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] == 0)).nonzero()[0]))
-    # Grab the total number of map pixels
-    tot_map_pix = np.float(len((Rover.ground_truth[:,:,1].nonzero()[0])))
-    # Calculate the percentage of ground truth map that has been successfully found
-    perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
-    # Calculate the number of good map pixel detections divided by total pixels 
+            map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
+                    test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+
+    # Statistics on the map results are kept up to date by the map view
+    # Percentage of the ground truth map that has been successfully found
+    perc_mapped = map_view.perc_mapped
+    # Number of good map pixel detections divided by total pixels
     # found to be navigable terrain
-    if tot_nav_pix > 0:
-        fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
-    else:
-        fidelity = 0
+    fidelity = map_view.fidelity
     # Flip the map for plotting so that the y-axis points upward in the display
-    map_add = np.flipud(map_add).astype(np.float32)
+    map_add = np.ascontiguousarray(np.flipud(map_add))
     # Add some text about map and rock sample detection results
     rover_x, rover_y = int(Rover.pos[0]), int(Rover.pos[1])
     rover_y = map_add.shape[0] - rover_y  # Flip y-axis
     yaw_rad = np.deg2rad(Rover.yaw)
     rover_front_x = int(rover_x + 10 * np.cos(yaw_rad))
     rover_front_y = int(rover_y - 10 * np.sin(yaw_rad))
-    rover_left_x = int(rover_x + 5 * np.cos(yaw_rad + np.pi / 4))
-    rover_left_y = int(rover_y - 5 * np.sin(yaw_rad + np.pi / 4))
-    rover_right_x = int(rover_x + 5 * np.cos(yaw_rad - np.pi / 4))
-    rover_right_y = int(rover_y - 5 * np.sin(yaw_rad - np.pi / 4))
-    points = np.array([[rover_front_x, rover_front_y], [rover_left_x, rover_left_y], [rover_right_x, rover_right_y]])
 
     cv2.arrowedLine(map_add, (rover_x, rover_y), (rover_front_x, rover_front_y), (255, 255, 255), 2, tipLength=0.7)
     cv2.putText(map_add,"Time: "+str(np.round(Rover.total_time, 1))+' s', (0, 10), 
@@ -155,15 +167,5 @@ def create_output_images(Rover):
                 cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
     cv2.putText(map_add,"  Collected: "+str(Rover.samples_collected), (0, 85), 
                 cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
-    # Convert map and vision image to base64 strings for sending to server
-    pil_img = Image.fromarray(map_add.astype(np.uint8))
-    buff = BytesIO()
-    pil_img.save(buff, format="JPEG")
-    encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
-    
-    pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
-    buff = BytesIO()
-    pil_img.save(buff, format="JPEG")
-    encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
-
-    return encoded_string1, encoded_string2
\ No newline at end of file
+
+    return map_add, Rover.vision_image
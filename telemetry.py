@@ -0,0 +1,62 @@
+import base64
+import numpy as np
+import cv2
+
+# Define a function to convert telemetry strings to float independent of decimal convention
+def convert_to_float(string_to_convert):
+    return float(string_to_convert.replace(',', '.'))
+
+# Define a function to convert "x;y" telemetry strings to a list of floats
+def convert_to_floats(string_to_convert):
+    return [convert_to_float(value) for value in string_to_convert.split(';')]
+
+# Scalar telemetry fields: (telemetry key, frame attribute, parser)
+telemetry_fields = (
+    ('speed', 'vel', convert_to_float),
+    ('position', 'pos', convert_to_floats),
+    ('yaw', 'yaw', convert_to_float),
+    ('pitch', 'pitch', convert_to_float),
+    ('roll', 'roll', convert_to_float),
+    ('throttle', 'throttle', convert_to_float),
+    ('steering_angle', 'steer', convert_to_float),
+    ('near_sample', 'near_sample', int),
+    ('picking_up', 'picking_up', int),
+    ('sample_count', 'sample_count', int),
+)
+
+# One decoded telemetry message
+# The scalar fields are attributes named after telemetry_fields, image is the
+# RGB camera image and jpeg the compressed bytes sent by the simulator
+class TelemetryFrame():
+    def __init__(self, data, jpeg, image):
+        self.data = data
+        self.jpeg = jpeg
+        self.image = image
+        for key, attribute, parser in telemetry_fields:
+            setattr(self, attribute, parser(data[key]))
+
+    # Known sample positions, only needed on the first frame
+    def samples_pos(self):
+        samples_xpos = np.int_(convert_to_floats(self.data["samples_x"]))
+        samples_ypos = np.int_(convert_to_floats(self.data["samples_y"]))
+        return samples_xpos, samples_ypos
+
+# Define a telemetry decoder
+# The JPEG camera image is decoded with cv2.imdecode straight from the base64
+# decoded bytes and converted to RGB into a buffer reused between frames
+# (pass out= to decode into another buffer)
+class TelemetryDecoder():
+    def __init__(self, shape=(160, 320, 3)):
+        self.image = np.zeros(shape, dtype=np.uint8)
+
+    def decode(self, data, out=None):
+        jpeg = base64.b64decode(data["image"])
+        bgr = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if bgr is None:
+            raise ValueError("Invalid camera image in telemetry")
+        if out is None:
+            if self.image.shape != bgr.shape:
+                self.image = np.zeros(bgr.shape, dtype=np.uint8)
+            out = self.image
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=out)
+        return TelemetryFrame(data, jpeg, out)
@@ -0,0 +1,52 @@
+import base64
+
+from metrics import metrics
+
+# Define the payload of the control replies sent to the simulator
+# transport='base64' is what the simulator understands: the commands as
+# strings and the inset images as base64 JPEG strings, '' when not sent.
+# transport='binary' sends the commands as numbers and the insets as the raw
+# JPEG bytes, which python-socketio ships as binary attachments instead of
+# text 33% larger; insets not sent are left out of the message.
+# Either way an inset identical to the last one sent to the same client
+# (sid, None for broadcasts) is not sent again.
+class ControlPayload():
+    def __init__(self, transport='base64'):
+        if transport not in ('base64', 'binary'):
+            raise ValueError("Unknown transport: {}".format(transport))
+        self.transport = transport
+        self._sent = {}
+
+    # Build the message of commands (throttle, brake, steer) and the JPEG
+    # bytes of the two insets (b'' when there is no new image)
+    def data(self, commands, image1, image2, sid=None):
+        sent = self._sent.setdefault(sid, [b'', b''])
+        images = []
+        for idx, image in enumerate((image1, image2)):
+            if not image or image == sent[idx]:
+                images.append(None)
+                continue
+            sent[idx] = image
+            metrics.increment('inset_bytes', len(image))
+            images.append(image)
+        if self.transport == 'binary':
+            data = {
+                'throttle': float(commands[0]),
+                'brake': float(commands[1]),
+                'steering_angle': float(commands[2]),
+            }
+            for name, image in zip(('inset_image1', 'inset_image2'), images):
+                if image is not None:
+                    data[name] = image
+            return data
+        return {
+            'throttle': commands[0].__str__(),
+            'brake': commands[1].__str__(),
+            'steering_angle': commands[2].__str__(),
+            'inset_image1': '' if images[0] is None else base64.b64encode(images[0]).decode("utf-8"),
+            'inset_image2': '' if images[1] is None else base64.b64encode(images[1]).decode("utf-8"),
+        }
+
+    # Forget the insets sent to a client, e.g. when it (re)connects
+    def forget(self, sid=None):
+        self._sent.pop(sid, None)
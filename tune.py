@@ -0,0 +1,230 @@
+# Sweep the perception and driving settings over a process pool
+#
+# Every candidate is a set of RoverState settings, evaluated either by
+# replaying recorded runs (perception settings only, the recorded rover drove
+# the same way whatever the settings) or by closed loop episodes of the
+# headless simulator (all settings). Candidates are scored on map fidelity
+# and mapped percentage against the ground truth map and on the compute time
+# per frame. Each worker appends its results to its own file in the cache
+# folder, so an interrupted sweep resumes where it stopped:
+#   $ python tune.py --recording run1 --recording run2 --search grid --workers 4
+#   $ python tune.py --simulate --episodes 4 --search random --samples 50
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Settings that can be tuned, with the values searched by default
+# A list gives the values to try, {'low': ..., 'high': ...} a range sampled
+# by the random search (integers when both bounds are integers)
+search_space = {
+    'nav_thresh': [(150, 150, 150), (160, 160, 160), (170, 170, 170)],
+    'rock_lower': [(24 - 5, 100, 100), (24 - 8, 80, 80)],
+    'rock_upper': [(24 + 5, 255, 255), (24 + 8, 255, 255)],
+    'view_range': {'low': 50, 'high': 100},
+    'bottom_offset': [4, 6, 8],
+    'stop_forward': {'low': 50, 'high': 200},
+    'go_forward': {'low': 300, 'high': 800},
+    'throttle_set': {'low': 0.2, 'high': 1.0},
+    'max_vel': {'low': 1.5, 'high': 4.0},
+}
+
+# Settings that change what a recorded run maps (the others only change how
+# the rover drives, which only the simulator can evaluate)
+perception_settings = ('nav_thresh', 'rock_lower', 'rock_upper', 'view_range', 'bottom_offset')
+
+# Define a function to read a search space from JSON, lists become tuples
+def load_space(path):
+    with open(path) as f:
+        space = json.load(f)
+    def as_value(value):
+        return tuple(value) if isinstance(value, list) else value
+    return {name: [as_value(value) for value in values] if isinstance(values, list) else values
+            for name, values in space.items()}
+
+# Define a function to list the values of a setting for the grid search
+def grid_values(values, steps=3):
+    if isinstance(values, dict):
+        grid = np.linspace(values['low'], values['high'], steps)
+        if isinstance(values['low'], int) and isinstance(values['high'], int):
+            grid = np.unique(np.rint(grid).astype(int))
+        return [value.item() for value in grid]
+    return list(values)
+
+# Define a function to generate the candidates of a grid search
+def grid_candidates(space, steps=3):
+    names = sorted(space)
+    for values in itertools.product(*(grid_values(space[name], steps) for name in names)):
+        yield dict(zip(names, values))
+
+# Define a function to generate the candidates of a random search
+def random_candidates(space, samples, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(samples):
+        candidate = {}
+        for name in sorted(space):
+            values = space[name]
+            if isinstance(values, dict):
+                if isinstance(values['low'], int) and isinstance(values['high'], int):
+                    candidate[name] = int(rng.integers(values['low'], values['high'] + 1))
+                else:
+                    candidate[name] = float(rng.uniform(values['low'], values['high']))
+            else:
+                candidate[name] = values[rng.integers(len(values))]
+        yield candidate
+
+# Define a function to apply a candidate to a RoverState
+def configure(Rover, candidate):
+    for name, value in candidate.items():
+        setattr(Rover, name, value)
+
+# Define a function to get the cache key of a candidate for an evaluation
+def candidate_key(candidate, evaluation):
+    text = json.dumps([candidate, evaluation], sort_keys=True, default=list)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+# Define a function to load the cached results of every worker
+def load_cache(folder):
+    cache = {}
+    if not os.path.isdir(folder):
+        return cache
+    for name in os.listdir(folder):
+        if not name.endswith('.jsonl'):
+            continue
+        with open(os.path.join(folder, name)) as f:
+            for line in f:
+                # A line cut short by an interruption is evaluated again
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                cache[result['key']] = result
+    return cache
+
+# Define a function to score a replayed recording
+def evaluate_recording(candidate, recording, ground_truth_path):
+    from recorder import RecordingReader
+    from replay import replay
+    from rover_state import RoverState, load_ground_truth
+    Rover = RoverState(load_ground_truth(ground_truth_path))
+    configure(Rover, candidate)
+    report = replay(RecordingReader(recording), Rover, render=False)
+    compute = np.add(report['latencies']['perception_step'], report['latencies']['decision_step'])
+    return {
+        'perc_mapped': report['perc_mapped'],
+        'fidelity': report['fidelity'],
+        'frame_ms': float(np.mean(compute) * 1000) if len(compute) else 0.0,
+    }
+
+# Define a function to score closed loop simulator episodes
+def evaluate_simulation(candidate, seeds, rovers, duration, ground_truth_path):
+    from simulator import run_episodes
+    dt = 0.1
+    results = run_episodes(seeds, rovers=rovers, duration=duration, dt=dt,
+                           configure=lambda Rover: configure(Rover, candidate),
+                           ground_truth_path=ground_truth_path)
+    return {
+        'perc_mapped': float(np.mean([result['perc_mapped'] for result in results])),
+        'fidelity': float(np.mean([result['fidelity'] for result in results])),
+        'samples_collected': float(np.mean([result['samples_collected'] for result in results])),
+        'frame_ms': float(np.mean([result['compute_time'] for result in results]) / (duration / dt) * 1000),
+    }
+
+# Define a function to evaluate a candidate in a worker and cache the result
+def evaluate(candidate, evaluation, key, cache_folder):
+    start = time.perf_counter()
+    if evaluation['kind'] == 'recording':
+        scores = [evaluate_recording(candidate, recording, evaluation['ground_truth'])
+                  for recording in evaluation['recordings']]
+        scores = {name: float(np.mean([score[name] for score in scores])) for name in scores[0]}
+    else:
+        scores = evaluate_simulation(candidate, evaluation['seeds'], evaluation['rovers'],
+                                     evaluation['duration'], evaluation['ground_truth'])
+    result = dict(scores, key=key, candidate=candidate, elapsed=time.perf_counter() - start)
+    # One file per worker process, appended as soon as a candidate is done
+    os.makedirs(cache_folder, exist_ok=True)
+    with open(os.path.join(cache_folder, 'worker-{}.jsonl'.format(os.getpid())), 'a') as f:
+        f.write(json.dumps(result, default=list) + '\n')
+    return result
+
+# Define a function to rank results, the map score (mapped % weighted by
+# fidelity) minus cost_weight points per millisecond of compute per frame
+def score(result, cost_weight=1.0):
+    return result['perc_mapped'] * result['fidelity'] / 100 - cost_weight * result['frame_ms']
+
+# Define a function to run a sweep, cached candidates are not evaluated again
+def sweep(candidates, evaluation, workers=0, cache_folder='tune_cache'):
+    cache = load_cache(cache_folder)
+    results, pending = [], []
+    for candidate in candidates:
+        key = candidate_key(candidate, evaluation)
+        if key in cache:
+            results.append(cache[key])
+        else:
+            pending.append((candidate, key))
+    print('{} candidates cached, {} to evaluate'.format(len(results), len(pending)))
+    if workers <= 0:
+        for count, (candidate, key) in enumerate(pending):
+            results.append(evaluate(candidate, evaluation, key, cache_folder))
+            print('{}/{} evaluated'.format(count + 1, len(pending)))
+        return results
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(evaluate, candidate, evaluation, key, cache_folder)
+                   for candidate, key in pending]
+        for count, future in enumerate(as_completed(futures)):
+            results.append(future.result())
+            print('{}/{} evaluated'.format(count + 1, len(pending)))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep rover settings')
+    parser.add_argument('--recording', action='append', default=[],
+                        help='Recorded run to replay (repeat for several runs).')
+    parser.add_argument('--simulate', action='store_true',
+                        help='Evaluate with simulator episodes instead of recordings.')
+    parser.add_argument('--episodes', type=int, default=4, help='Simulator episodes per candidate.')
+    parser.add_argument('--rovers', type=int, default=4, help='Rovers per simulator episode.')
+    parser.add_argument('--duration', type=float, default=120, help='Simulated seconds per episode.')
+    parser.add_argument('--ground-truth', type=str, default=None,
+                        help='Ground truth map the candidates are scored against.')
+    parser.add_argument('--space', type=str, default='',
+                        help='JSON search space, defaults to the built-in one.')
+    parser.add_argument('--search', choices=['grid', 'random'], default='random',
+                        help='Search strategy.')
+    parser.add_argument('--steps', type=int, default=3, help='Grid values per range.')
+    parser.add_argument('--samples', type=int, default=50, help='Random search candidates.')
+    parser.add_argument('--seed', type=int, default=0, help='Random search seed.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes (0 runs in this process).')
+    parser.add_argument('--cache', type=str, default='tune_cache',
+                        help='Folder of the cached results.')
+    parser.add_argument('--cost-weight', type=float, default=1.0,
+                        help='Score points lost per millisecond of compute per frame.')
+    parser.add_argument('--top', type=int, default=10, help='Number of candidates to show.')
+    args = parser.parse_args()
+
+    space = load_space(args.space) if args.space else dict(search_space)
+    if args.simulate:
+        evaluation = {'kind': 'simulation', 'seeds': list(range(args.episodes)), 'rovers': args.rovers,
+                      'duration': args.duration, 'ground_truth': args.ground_truth}
+    elif args.recording:
+        evaluation = {'kind': 'recording', 'recordings': [os.path.abspath(path) for path in args.recording],
+                      'ground_truth': args.ground_truth}
+        # Driving settings do not change a recorded run
+        space = {name: values for name, values in space.items() if name in perception_settings}
+    else:
+        parser.error('give --recording or --simulate')
+    if args.search == 'grid':
+        candidates = grid_candidates(space, args.steps)
+    else:
+        candidates = random_candidates(space, args.samples, args.seed)
+    results = sweep(candidates, evaluation, args.workers, args.cache)
+    results.sort(key=lambda result: score(result, args.cost_weight), reverse=True)
+    for result in results[:args.top]:
+        print('score {:7.2f}  mapped {:5.1f}%  fidelity {:5.1f}%  {:6.2f} ms/frame  {}'.format(
+              score(result, args.cost_weight), result['perc_mapped'], result['fidelity'],
+              result['frame_ms'], json.dumps(result['candidate'], sort_keys=True)))